@@ -0,0 +1,174 @@
+"""
+pytest-benchmark suite for the capacity check, timing every parsing step on the
+synthetic replies of each device model and whole runs through a mocked Device.
+
+    python3 -m pip install pytest pytest-benchmark
+    python3 -m pytest benchmarks/bench_capacity.py --benchmark-only
+
+Compare against a saved baseline with --benchmark-save=<name> and
+--benchmark-compare, the fleet runs can be skipped with -k "not fleet".
+"""
+
+from copy import deepcopy
+from queue import Queue
+import os
+import sys
+
+import pytest
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import capacity_check  # noqa: E402
+from capacity_check import Capacity, JunosDevice, parse_interface_name  # noqa: E402
+from synthetic import MODELS, SyntheticDevice  # noqa: E402
+
+FLEET_SIZES = [1, 100, 10000]
+ROLLUP_PORTS = 1000000
+
+
+@pytest.fixture(params=sorted(MODELS))
+def device(request):
+    model = request.param
+    device = JunosDevice(f"{model}-0", Queue(), False, SyntheticDevice(f"{model}-0"))
+    device.connect()
+    return device
+
+
+def linecard_interfaces(device):
+    # the same bucketing check_bandwidth does before the capacity calculations
+    interface_details = device.get_interface_details(
+        device.get_interface_configuration()
+    )
+    chassis_details = device.get_chassis_info()
+    linecards = []
+    for linecard, linecard_details in chassis_details["linecards"].items():
+        interfaces = {}
+        for interface, details in interface_details.items():
+            name = parse_interface_name(interface)
+            if (
+                name is not None
+                and name.fpc == linecard.split(" ")[-1]
+                and f"Xcvr {name.port}"
+                in linecard_details["interfaces"].get(f"PIC {name.pic}", {})
+            ):
+                interfaces[interface] = details
+        linecards.append((interfaces, linecard_details))
+    return linecards
+
+
+def test_get_interface_configuration(benchmark, device):
+    benchmark(device.get_interface_configuration)
+
+
+def test_get_interface_details(benchmark, device):
+    interface_config = device.get_interface_configuration()
+    benchmark(device.get_interface_details, interface_config)
+
+
+def test_get_address(benchmark, device):
+    interface_info = device.device.rpc.get_interface_information()
+    records = list(device.iter_interface_records(interface_info))
+    logical_interfaces = device.index_logical_interfaces(records)
+    names = [record["name"] for record in records]
+
+    def resolve():
+        resolved = {}
+        for name in names:
+            device.get_address(logical_interfaces, name, resolved)
+
+    benchmark(resolve)
+
+
+def test_get_chassis_info(benchmark, device):
+    benchmark(device.get_chassis_info)
+
+
+def test_get_linecard_capacity(benchmark, device):
+    linecards = linecard_interfaces(device)
+
+    def capacity(linecards):
+        for interfaces, linecard_details in linecards:
+            device.get_linecard_capacity(interfaces, linecard_details)
+
+    # the linecard details are updated in place, start every round from a copy
+    benchmark.pedantic(capacity, setup=lambda: ((deepcopy(linecards),), {}), rounds=20)
+
+
+def test_check_bandwidth(benchmark, device):
+    def check():
+        device.check_bandwidth()
+        device.queue.get()
+
+    benchmark(check)
+
+
+def test_write_data(benchmark, tmp_path):
+    entries = []
+    for model in sorted(MODELS):
+        device = JunosDevice(model, Queue(), False, SyntheticDevice(model))
+        device.check_bandwidth()
+        entries.append(device.queue.get())
+
+    def setup():
+        capacity = Capacity(
+            output_file=str(tmp_path / "bandwidth_data.xlsx"), log_rpc=False
+        )
+        capacity.initialize_outputs()
+        for _ in range(100):
+            for entry in entries:
+                capacity.queue.put(deepcopy(entry))
+        capacity.queue.put(None)
+        return (capacity,), {}
+
+    def write(capacity):
+        capacity.write_data()
+        capacity.close_outputs()
+
+    benchmark.pedantic(write, setup=setup, rounds=5)
+
+
+def test_rollups(benchmark, tmp_path):
+    pytest.importorskip("pandas")
+    entries = []
+    for model in sorted(MODELS):
+        device = JunosDevice(model, Queue(), False, SyntheticDevice(model))
+        device.check_bandwidth()
+        entries.append(device.queue.get())
+
+    # repeat the devices over 10 sites until the fleet has a million ports
+    capacity = Capacity(
+        output_file=str(tmp_path / "bandwidth_data.xlsx"),
+        log_rpc=False,
+        output_formats=[],
+        rollups=True,
+    )
+    capacity.initialize_outputs()
+    device = 0
+    while len(capacity.rollups.port_optic) < ROLLUP_PORTS:
+        entry = deepcopy(entries[device % len(entries)])
+        entry["chassis"][0] = f"host-{device}"
+        capacity.host_tags[f"host-{device}"] = {"site": f"site-{device % 10}"}
+        capacity.queue.put(entry)
+        capacity.queue.put(None)
+        capacity.write_data()
+        device += 1
+
+    benchmark(capacity.rollups.tables)
+
+
+@pytest.mark.parametrize("devices", FLEET_SIZES)
+def test_fleet(benchmark, tmp_path, monkeypatch, devices):
+    models = sorted(MODELS)
+    hosts = [f"{models[host % len(models)]}-{host}" for host in range(devices)]
+    with open(tmp_path / "hosts.yaml", "w") as hosts_file:
+        yaml.safe_dump({"hosts": hosts}, hosts_file)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(capacity_check, "Device", SyntheticDevice)
+
+    def run():
+        capacity = Capacity(log_rpc=False, split_sheets=True)
+        capacity.get_capacity_usage()
+        assert len(capacity.reported_hosts) == devices
+
+    benchmark.pedantic(run, rounds=1 if devices > 100 else 3)
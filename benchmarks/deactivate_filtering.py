@@ -0,0 +1,79 @@
+"""
+Compares the deactivate filtering of get_interface_configuration against the
+previous list based implementation on synthetic set configurations.
+
+    python3 benchmarks/deactivate_filtering.py
+"""
+
+from queue import Queue
+from time import perf_counter
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from capacity_check import ArchiveDevice, JunosDevice  # noqa: E402
+
+
+def synthetic_config(fpcs, units_per_port=4, deactivate_every=10):
+    config = []
+    for fpc in range(fpcs):
+        for pic in range(4):
+            for port in range(12):
+                name = f"et-{fpc}/{pic}/{port}"
+                config.append(f"set interfaces {name} description uplink-{name}")
+                config.append(f"set interfaces {name} mtu 9192")
+                for unit in range(units_per_port):
+                    config.append(f"set interfaces {name} unit {unit} vlan-id {unit}")
+                    config.append(
+                        f"set interfaces {name} unit {unit} family inet address "
+                        f"10.{fpc}.{pic * 12 + port}.{unit * 2}/31"
+                    )
+                    if (port * units_per_port + unit) % deactivate_every == 0:
+                        config.append(f"deactivate interfaces {name} unit {unit}")
+    return config
+
+
+def list_filtering(interface_config):
+    # previous implementation, quadratic in the number of lines
+    deactivate_config = [
+        config for config in interface_config if config.startswith("deactivate")
+    ]
+    interface_config = [
+        config for config in interface_config if config not in deactivate_config
+    ]
+    return [
+        config
+        for config in interface_config
+        if all(dc[len("deactivate ") :] not in config for dc in deactivate_config)
+    ]
+
+
+def timed(function, *args):
+    start = perf_counter()
+    result = function(*args)
+    return result, perf_counter() - start
+
+
+def main():
+    device = JunosDevice("synthetic", Queue(), False, ArchiveDevice("synthetic"))
+
+    print(f"{'lines':>8} {'deactivated':>12} {'list (s)':>10} {'tree (s)':>10}")
+    for fpcs in [1, 4, 16, 64, 256]:
+        config = synthetic_config(fpcs)
+        deactivated = sum(1 for line in config if line.startswith("deactivate"))
+
+        tree_result, tree_time = timed(device.filter_deactivated_configuration, config)
+        # the list implementation takes minutes on the larger configs
+        if len(config) <= 10000:
+            list_result, list_time = timed(list_filtering, config)
+            assert list_result == tree_result
+            list_time = f"{list_time:.3f}"
+        else:
+            list_time = "skipped"
+
+        print(f"{len(config):>8} {deactivated:>12} {list_time:>10} {tree_time:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+"""
+Generates synthetic but realistic replies for the RPCs used by the capacity
+check, from a small EX access switch up to fully loaded MX and PTX chassis with
+channelized ports and AE bundles.
+
+    python3 benchmarks/synthetic.py <directory> <model> <number of devices>
+
+writes the replies in the rpc_logs.zip layout so they can be replayed with
+Capacity(replay=<directory>).
+"""
+
+from fnmatch import fnmatch
+from functools import lru_cache
+from random import Random
+import os
+import re
+import sys
+
+from lxml import etree
+import yaml
+
+# statements the filtered configuration request selects, see JunosDevice.FILTERED_CONFIG
+FILTERED_STATEMENT = re.compile(
+    r"^(set|deactivate) interfaces \S+( unit \d+( family .*)?| (gig)?ether-options .*)?$"
+)
+# fields of the physical and logical interfaces that are part of terse replies
+TERSE_FIELDS = ["name", "admin-status", "oper-status", "logical-interface"]
+
+# chassis layouts: FPCs, PICs per FPC, ports per PIC, port speed, channels per
+# channelized port, ratio of channelized ports and the software version
+MODELS = {
+    "ex": {
+        "chassis": "EX4300-48T",
+        "linecard": "EX4300-48T",
+        "fpcs": 1,
+        "pics": [("ge", 48, "1000mbps", None), ("xe", 4, "10Gbps", "SFP+-10G-SR")],
+        "channels": 0,
+        "channelized": 0,
+        "version": "20.4R3-S5",
+        "layer2": True,
+    },
+    "mx": {
+        "chassis": "MX960",
+        "linecard": "MPC7E 3D MRATE-12xQSFPP-XGE-XLGE-CGE",
+        "fpcs": 11,
+        "pics": [
+            ("et", 6, "100Gbps", "QSFP-100GBASE-LR4"),
+            ("et", 6, "100Gbps", "QSFP-100GBASE-SR4"),
+        ],
+        "channels": 4,
+        "channelized": 0.25,
+        "version": "22.4R2-S2",
+        "layer2": False,
+    },
+    "ptx": {
+        "chassis": "PTX10008",
+        "linecard": "JNP10K-LC1201",
+        "fpcs": 8,
+        "pics": [("et", 36, "400Gbps", "QSFP56-DD-400GBASE-DR4")],
+        "channels": 4,
+        "channelized": 0.5,
+        "version": "22.4R2-S1-EVO",
+        "layer2": False,
+    },
+}
+
+
+def _element(parent, tag, text=None):
+    element = etree.SubElement(parent, tag)
+    if text is not None:
+        element.text = str(text)
+    return element
+
+
+def _ports(model):
+    """
+    Yields (name, speed, fpc, pic, port, xcvr model) for every physical port
+    """
+    layout = MODELS[model]
+    for fpc in range(layout["fpcs"]):
+        for pic, (prefix, ports, speed, xcvr) in enumerate(layout["pics"]):
+            for port in range(ports):
+                yield f"{prefix}-{fpc}/{pic}/{port}", speed, fpc, pic, port, xcvr
+
+
+def _physical_interfaces(model, rng):
+    """
+    Yields (name, speed, unit address or None, ae bundle or None, admin status)
+    for every physical interface, channelized ports yield one entry per channel
+    """
+    layout = MODELS[model]
+    ae = 0
+    for name, speed, fpc, pic, port, xcvr in _ports(model):
+        names = [name]
+        if xcvr is not None and rng.random() < layout["channelized"]:
+            channel_speed = f"{int(speed[:-4]) // layout['channels']}Gbps"
+            names = [f"{name}:{channel}" for channel in range(layout["channels"])]
+            speed = channel_speed
+
+        for name in names:
+            address = f"10.{fpc}.{pic * 64 + port}.{rng.randrange(0, 254, 2)}"
+            bundle = None
+            # roughly every sixth port is bundled, in pairs
+            if not layout["layer2"] and rng.random() < 0.16:
+                bundle = f"ae{ae // 2}"
+                ae += 1
+                address = None
+            admin_status = "down" if rng.random() < 0.1 else "up"
+            yield name, speed, address, bundle, admin_status
+
+    for bundle in range((ae + 1) // 2):
+        yield f"ae{bundle}", None, f"172.16.{bundle // 256}.{bundle % 256}", None, "up"
+
+
+def interface_config(model, seed=0):
+    rng = Random(seed)
+    layout = MODELS[model]
+    config = []
+    # draw the interfaces first so they match the ones interface_information
+    # draws from the same seed
+    interfaces = list(_physical_interfaces(model, rng))
+    for name, speed, address, bundle, _ in interfaces:
+        config.append(f'set interfaces {name} description "synthetic {name}"')
+        if name.startswith("ae"):
+            config.append(f"set interfaces {name} aggregated-ether-options lacp active")
+            config.append(
+                f"set interfaces {name} unit 0 family inet address {address}/31"
+            )
+            config.append(f"set interfaces {name} unit 0 family mpls")
+        elif bundle is not None:
+            config.append(f"set interfaces {name} gigether-options 802.3ad {bundle}")
+        elif layout["layer2"] and name.startswith("ge"):
+            config.append(
+                f"set interfaces {name} unit 0 family ethernet-switching "
+                "interface-mode trunk"
+            )
+            config.append(
+                f"set interfaces {name} unit 0 family ethernet-switching "
+                "vlan members [ 10 20 30 ]"
+            )
+        else:
+            config.append(f"set interfaces {name} mtu 9192")
+            config.append(
+                f"set interfaces {name} unit 0 family inet address {address}/31"
+            )
+            config.append(f"set interfaces {name} unit 0 family iso")
+            # some units are kept around deactivated
+            if rng.random() < 0.05:
+                config.append(f"deactivate interfaces {name} unit 0")
+
+    config.append("set interfaces lo0 unit 0 family inet address 192.0.2.1/32")
+    config.append("set interfaces fxp0 unit 0 family inet address 198.51.100.1/24")
+
+    reply = etree.Element("configuration-set")
+    reply.text = "\n" + "\n".join(config) + "\n"
+    return etree.tostring(reply)
+
+
+def interface_information(model, seed=0):
+    rng = Random(seed)
+    reply = etree.Element("interface-information")
+    interfaces = list(_physical_interfaces(model, rng))
+    interfaces += [
+        ("lo0", "Unspecified", "192.0.2.1", None, "up"),
+        ("fxp0", "1000mbps", "198.51.100.1", None, "up"),
+    ]
+    for name, speed, address, bundle, admin_status in interfaces:
+        physical = _element(reply, "physical-interface")
+        _element(physical, "name", name)
+        _element(physical, "admin-status", admin_status)
+        _element(physical, "oper-status", admin_status)
+        _element(physical, "description", f"synthetic {name}")
+        _element(physical, "if-type", "Ethernet")
+        _element(physical, "link-level-type", "Ethernet")
+        _element(physical, "mtu", "9192")
+        _element(physical, "speed", speed or "Unspecified")
+        statistics = _element(physical, "traffic-statistics")
+        for counter in [
+            "input-bytes",
+            "output-bytes",
+            "input-packets",
+            "output-packets",
+        ]:
+            _element(statistics, counter, rng.randrange(10**12))
+        errors = _element(physical, "input-error-list")
+        for counter in ["input-errors", "input-drops", "framing-errors", "input-runts"]:
+            _element(errors, counter, 0)
+        if not name.startswith(("ae", "lo", "fxp")):
+            optics = _element(physical, "optics-diagnostics")
+            _element(optics, "laser-output-power-dbm", "-1.20")
+            _element(optics, "rx-signal-avg-optical-power-dbm", "-2.35")
+            _element(optics, "module-temperature", "38 degrees C")
+
+        logical = _element(physical, "logical-interface")
+        _element(logical, "name", f"{name}.0")
+        family = _element(logical, "address-family")
+        if bundle is not None:
+            _element(family, "address-family-name", "aenet")
+            _element(family, "ae-bundle-name", f"{bundle}.0")
+        elif address is not None:
+            _element(family, "address-family-name", "inet")
+            interface_address = _element(family, "interface-address")
+            _element(interface_address, "ifa-destination", f"{address}/31")
+            _element(interface_address, "ifa-local", address)
+        else:
+            _element(family, "address-family-name", "eth-switch")
+    return etree.tostring(reply)
+
+
+def chassis_inventory(model, seed=0):
+    rng = Random(seed)
+    layout = MODELS[model]
+    reply = etree.Element("chassis-inventory")
+    chassis = _element(reply, "chassis")
+    _element(chassis, "name", "Chassis")
+    _element(chassis, "serial-number", f"JN{rng.randrange(16**8):08X}")
+    _element(chassis, "description", layout["chassis"])
+
+    for engine in range(2):
+        routing_engine = _element(chassis, "chassis-module")
+        _element(routing_engine, "name", f"Routing Engine {engine}")
+        _element(routing_engine, "serial-number", f"RE{rng.randrange(10**8):08d}")
+        _element(routing_engine, "description", "RE-S-2X00x6")
+
+    pics = {}
+    for _, _, fpc, pic, port, xcvr in _ports(model):
+        pics.setdefault(fpc, {}).setdefault(pic, []).append((port, xcvr))
+
+    for fpc, fpc_pics in pics.items():
+        module = _element(chassis, "chassis-module")
+        _element(module, "name", f"FPC {fpc}")
+        _element(module, "version", f"REV {rng.randrange(10, 50)}")
+        _element(module, "part-number", "750-056519")
+        _element(module, "serial-number", f"FPC{rng.randrange(10**8):08d}")
+        _element(module, "description", layout["linecard"])
+        cpu = _element(module, "chassis-sub-module")
+        _element(cpu, "name", "CPU")
+        _element(cpu, "description", "SMPC PMB")
+        for pic, ports in fpc_pics.items():
+            sub_module = _element(module, "chassis-sub-module")
+            _element(sub_module, "name", f"PIC {pic}")
+            _element(sub_module, "description", f"{len(ports)}x ports")
+            for port, xcvr in ports:
+                # copper ports have no transceiver
+                if xcvr is None:
+                    continue
+                transceiver = _element(sub_module, "chassis-sub-sub-module")
+                _element(transceiver, "name", f"Xcvr {port}")
+                _element(transceiver, "version", "REV 01")
+                _element(transceiver, "part-number", "740-061405")
+                _element(transceiver, "serial-number", f"X{rng.randrange(10**9):09d}")
+                _element(transceiver, "description", xcvr)
+    return etree.tostring(reply)
+
+
+def license_summary(model, seed=0):
+    rng = Random(seed)
+    reply = etree.Element("license-summary-information")
+    feature = _element(reply, "feature-summary")
+    _element(feature, "name", "port_bandwidth_usage")
+    _element(feature, "description", "Port Bandwidth Usage (PAYG license)")
+    licensed = rng.randrange(1, 20) * 1000
+    _element(feature, "licensed", licensed)
+    _element(feature, "used-licensed", rng.randrange(licensed))
+    return etree.tostring(reply)
+
+
+@lru_cache(maxsize=None)
+def synthetic_replies(model, seed=0):
+    """
+    Returns the raw replies of a device keyed on their RPC log names, the same
+    layout as CollectedDevice.replies
+    """
+    return {
+        "facts.yaml": yaml.safe_dump({"version": MODELS[model]["version"]}).encode(),
+        "interface_config.xml": interface_config(model, seed),
+        "interface_media.xml": interface_information(model, seed),
+        "chassis_hardware.xml": chassis_inventory(model, seed),
+        "license_summary.xml": license_summary(model, seed),
+    }
+
+
+class SyntheticDevice:
+    """
+    Stand-in for a live PyEZ Device that answers with synthetic replies, every
+    RPC parses its reply like PyEZ does
+    """
+
+    def __init__(self, host, user=None, password=None, model=None, seed=0):
+        self.host = host
+        # the model can be chosen by naming the host after it, e.g. ptx-42
+        if model is None:
+            model = host.split("-")[0] if host.split("-")[0] in MODELS else "mx"
+        self.replies = synthetic_replies(model, seed)
+        self.facts = {}
+        self.rpc = self
+
+    def open(self):
+        self.facts = yaml.safe_load(self.replies["facts.yaml"])
+
+    def close(self):
+        pass
+
+    def _reply(self, log_file):
+        return etree.fromstring(self.replies[log_file])
+
+    def get_config(self, filter_xml=None, **kwargs):
+        reply = self._reply("interface_config.xml")
+        # a selective filter leaves out every statement it doesn't select
+        if filter_xml is not None and filter_xml.startswith("<configuration>"):
+            reply.text = "\n".join(
+                config
+                for config in reply.text.splitlines()
+                if FILTERED_STATEMENT.match(config)
+            )
+        return reply
+
+    def get_interface_information(self, interface_name=None, terse=False, **kwargs):
+        reply = self._reply("interface_media.xml")
+        for physical_interface in reply.findall("physical-interface"):
+            if interface_name is not None and not fnmatch(
+                physical_interface.findtext("name"), interface_name
+            ):
+                reply.remove(physical_interface)
+                continue
+            if terse:
+                for field in physical_interface:
+                    if field.tag not in TERSE_FIELDS:
+                        physical_interface.remove(field)
+        return reply
+
+    def get_chassis_inventory(self, **kwargs):
+        return self._reply("chassis_hardware.xml")
+
+    def get_license_summary_information(self, **kwargs):
+        return self._reply("license_summary.xml")
+
+    def get_commit_information(self, **kwargs):
+        return etree.fromstring(
+            b"<commit-information><commit-history><sequence-number>0</sequence-number>"
+            b"<date-time>2024-01-01 00:00:00 UTC</date-time><user>synthetic</user>"
+            b"</commit-history></commit-information>"
+        )
+
+
+def write_archive(directory, model, devices, seed=0):
+    os.makedirs(directory, exist_ok=True)
+    replies = synthetic_replies(model, seed)
+    for device in range(devices):
+        for log_file, reply in replies.items():
+            path = os.path.join(directory, f"{model}-{device}_{log_file}")
+            with open(path, "wb") as rpc_log:
+                rpc_log.write(reply)
+
+
+if __name__ == "__main__":
+    write_archive(sys.argv[1], sys.argv[2], int(sys.argv[3]))
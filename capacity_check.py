@@ -1,25 +1,360 @@
+from argparse import ArgumentParser
+from array import array
 from getpass import getpass
-from threading import Thread
+from threading import BoundedSemaphore, Condition, Lock, Thread
 from queue import Queue
-from collections import defaultdict
-from jnpr.junos import Device
-from xlsxwriter import Workbook
-from xlsxwriter.workbook import Worksheet
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import AsyncExitStack, contextmanager
+from copy import deepcopy
+from functools import partial, wraps
+from io import BytesIO
+from random import uniform
+from tempfile import SpooledTemporaryFile
+from time import perf_counter, sleep, strftime, time
 from zipfile import ZipFile
-from lxml import etree
-from jnpr.junos.exception import ConnectTimeoutError
+import asyncio
+import bz2
+import cProfile
+import csv
+import hashlib
+import importlib
+import json
+import lzma
 import os
 import re
+import shutil
+import sqlite3
+import struct
+import sys
 import yaml
+import zipfile
+import zlib
+
+
+class LazyImport:
+    """
+    Stand-in for a module (or one of its attributes) that is only imported on
+    first use, so PyEZ, lxml and xlsxwriter stay off the startup path of the
+    modes that don't need them
+    """
+
+    def __init__(self, module, attribute=None):
+        self.module = module
+        self.attribute = attribute
+        self.target = None
+
+    def load(self):
+        if self.target is None:
+            target = importlib.import_module(self.module)
+            if self.attribute is not None:
+                target = getattr(target, self.attribute)
+            self.target = target
+        return self.target
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+
+Device = LazyImport("jnpr.junos", "Device")
+Workbook = LazyImport("xlsxwriter", "Workbook")
+etree = LazyImport("lxml.etree")
+
+
+def junos_exceptions(*names):
+    """
+    Returns the PyEZ exception classes for an except clause, as PyEZ is imported
+    lazily none of them can have been raised while it isn't loaded yet
+    """
+    module = sys.modules.get("jnpr.junos.exception")
+    if module is None:
+        return ()
+    return tuple(getattr(module, name) for name in names)
+
+
+class CredentialProvider:
+    """
+    Looks up the device credentials in the environment, the system keyring or an
+    SSH key and only prompts for them when running interactively
+    """
+
+    USERNAME_VARIABLE = "CAPACITY_USERNAME"
+    PASSWORD_VARIABLE = "CAPACITY_PASSWORD"
+    KEYRING_SERVICE = "capacity_check"
+
+    def __init__(self, username=None, ssh_private_key_file=None, interactive=None):
+        self.username = username
+        self.ssh_private_key_file = ssh_private_key_file
+        if interactive is None:
+            interactive = sys.stdin.isatty()
+        self.interactive = interactive
+
+    def get_username(self):
+        username = self.username or os.environ.get(self.USERNAME_VARIABLE)
+        if username is None and self.interactive:
+            username = input("Username: ")
+        return username
+
+    def _keyring_password(self, username):
+        # keyring is optional, without it the password has to come from elsewhere
+        try:
+            import keyring
+        except ImportError:
+            return None
+        try:
+            return keyring.get_password(self.KEYRING_SERVICE, username)
+        except Exception as e:
+            print(f"Could not read the password from the keyring: {e}")
+            return None
+
+    def get_password(self, username):
+        password = os.environ.get(self.PASSWORD_VARIABLE)
+        if password is None and username is not None:
+            password = self._keyring_password(username)
+        # an SSH key (or agent) is used when no password was found
+        if password is None and self.ssh_private_key_file is None and self.interactive:
+            password = getpass()
+        return password
+
+    def credentials(self):
+        """
+        Returns the credentials as PyEZ Device arguments, None values are left
+        out so PyEZ falls back to its defaults (current user, SSH agent and keys)
+        """
+        username = self.get_username()
+        credentials = {
+            "user": username,
+            "password": self.get_password(username),
+            "ssh_private_key_file": self.ssh_private_key_file,
+        }
+        return {name: value for name, value in credentials.items() if value}
+
 
+InterfaceName = namedtuple("InterfaceName", ["prefix", "fpc", "pic", "port", "channel"])
+# what DeviceCache.lookup decided for a device, valid entries are served as is and
+# the inventory of fresh ones is reused
+CacheLookup = namedtuple("CacheLookup", ["cached", "revision", "valid", "fresh"])
+INTERFACE_NAME_PATTERN = re.compile(
+    r"^(?P<prefix>[a-z]+)-(?P<fpc>\d+)/(?P<pic>\d+)/(?P<port>\d+)(?::(?P<channel>\d+))?$"
+)
+
+
+def parse_interface_name(name):
+    """
+    Split a physical interface name such as et-1/0/4:2 into its prefix, FPC, PIC,
+    port and channel (None when not channelized), returns None for other names
+    """
+    match = INTERFACE_NAME_PATTERN.match(name)
+    if match is None:
+        return None
+    return InterfaceName(*match.groups())
+
+
+def check_limits(limits):
+    # a limit below 1 would never hand out the hosts it applies to
+    for tag, tag_limits in limits.items():
+        for value, limit in tag_limits.items():
+            if not isinstance(limit, int) or limit < 1:
+                raise ValueError(
+                    f"The {tag} limit of {value} must be at least 1, got {limit!r}"
+                )
 
-username = input("Username: ")
-password = getpass()
+
+def timed(method):
+    # record the time spent in a JunosDevice method under the method's name
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._timed(method.__name__):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def run_profiled(function, name, profile=None, profile_dir="profiles"):
+    """
+    Runs function under cProfile ("cprofile") or pyinstrument ("pyinstrument")
+    and saves the result as <profile_dir>/<name>.prof or <name>.html
+    """
+    if profile is None:
+        return function()
+
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(profile_dir, name.replace("/", "_"))
+    if profile == "pyinstrument":
+        # pyinstrument is only needed when it's used for profiling
+        from pyinstrument import Profiler
+
+        profiler = Profiler()
+        profiler.start()
+        try:
+            return function()
+        finally:
+            profiler.stop()
+            with open(f"{path}.html", "w") as profile_file:
+                profile_file.write(profiler.output_html())
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function)
+    finally:
+        profiler.dump_stats(f"{path}.prof")
+
+
+def failure_reason(error):
+    # connection errors are self explanatory, their message only repeats the host
+    if isinstance(error, junos_exceptions("ConnectError") + (asyncio.TimeoutError,)):
+        return type(error).__name__
+    return f"{type(error).__name__}: {error}"
+
+
+class CountingWriter:
+    """
+    Passes writes on to a file while counting the bytes written, without a file
+    the writes are only counted
+    """
+
+    def __init__(self, file=None):
+        self.file = file
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.file is None:
+            return len(data)
+        return self.file.write(data)
+
+
+def shard_hosts(device_list, host_tags, shards, shard_by="hash"):
+    """
+    Splits the hosts into shards with rendezvous hashing on the hostname, or on
+    a tag (e.g. site or jumphost) so the hosts sharing it end up in the same
+    shard. Adding or removing a shard only moves the hosts of that shard
+    """
+    assignment = {shard: [] for shard in range(shards)}
+    for device_name in device_list:
+        key = device_name
+        if shard_by != "hash":
+            key = host_tags.get(device_name, {}).get(shard_by, device_name)
+        shard = max(
+            range(shards),
+            key=lambda shard: hashlib.md5(f"{shard}:{key}".encode()).digest(),
+        )
+        assignment[shard].append(device_name)
+    return assignment
+
+
+def shard_directory(output_file, shard):
+    return os.path.join(os.path.dirname(output_file), f"shard{shard}")
+
+
+def shard_options(options, shard):
+    """
+    Returns the Capacity options of one shard, every shard writes its results as
+    JSONL together with its RPC logs and run summary to its own directory
+    """
+    output_file = options.get("output_file", "bandwidth_data.xlsx")
+    directory = shard_directory(output_file, shard)
+    journal_file = options.get("journal_file")
+    if journal_file is not None:
+        journal_file = os.path.join(directory, os.path.basename(journal_file))
+    return {
+        **options,
+        "journal_file": journal_file,
+        "shard": shard,
+        "output_file": os.path.join(directory, os.path.basename(output_file)),
+        "output_formats": ["jsonl"],
+        "archive_path": os.path.join(directory, "rpc_logs.zip"),
+        "metrics_file": os.path.join(directory, "run_summary.json"),
+        "history_db": None,
+        "rollups": False,
+    }
+
+
+def run_shard(options, shard):
+    Capacity(**shard_options(options, shard)).get_capacity_usage()
+
+
+def run_shards(options):
+    """
+    Runs every shard as a separate local collector process and merges their
+    results, the same as running each shard on its own node and merging after
+    """
+    with ProcessPoolExecutor(options["shards"]) as shard_pool:
+        futures = [
+            shard_pool.submit(run_shard, options, shard)
+            for shard in range(options["shards"])
+        ]
+        for future in futures:
+            future.result()
+    Capacity(**options).merge_shards()
+
+
+def parse_collected_replies(
+    device_name,
+    replies,
+    cache=None,
+    timings=None,
+    profile=None,
+    profile_dir=None,
+    cache_lookup=None,
+):
+    """
+    Runs the capacity check against the raw replies of a device, used as the
+    parsing stage so it can run in a separate process from the collection
+    """
+    results = Queue()
+    device = JunosDevice(
+        device_name, results, False, CollectedDevice(device_name, replies), cache
+    )
+    # carry over the connect and RPC timings and the cache decision of the
+    # collection stage
+    device.timings.update(timings or {})
+    device.cache_lookup = cache_lookup
+    run_profiled(device.check_bandwidth, device_name, profile, profile_dir)
+    return None if results.empty() else results.get()
 
 
 class Capacity:
     def __init__(
-        self, hosts_file="hosts.yaml", output_file="bandwidth_data.xlsx", log_rpc=True
+        self,
+        hosts_file="hosts.yaml",
+        output_file="bandwidth_data.xlsx",
+        log_rpc=True,
+        max_workers=20,
+        limits=None,
+        replay=None,
+        split_sheets=False,
+        output_formats=("xlsx",),
+        cache_dir=None,
+        cache_ttl=86400,
+        cache_max_age=604800,
+        engine="threads",
+        rpc_timeout=300,
+        parse_processes=None,
+        metrics_file="run_summary.json",
+        profile=None,
+        profile_dir="profiles",
+        connect_retries=2,
+        retry_backoff=1,
+        host_retries=1,
+        deadline=None,
+        ssh_control_dir=".capacity_ssh",
+        ssh_control_persist=60,
+        archive_path="rpc_logs.zip",
+        archive_compression=None,
+        archive_compresslevel=None,
+        rpc_filtering=False,
+        credentials=None,
+        history_db=None,
+        shards=None,
+        shard=None,
+        shard_by="hash",
+        journal_file=None,
+        resume=False,
+        rollups=False,
     ):
         self.HOSTS_FILE = hosts_file
         self.DATA_FILENAME = output_file
@@ -38,75 +373,476 @@ class Capacity:
             "Available (gbps)",
             "Remaining (gbps)",
         ]
-        self.workbook = None
-        self.worksheet = None
-        self.entry_row = 1
-        self.log_rpc = log_rpc
-        self.queue = Queue()
-
-    def initialize_workbook(self):
-        self.workbook = Workbook(self.DATA_FILENAME)
-        self.worksheet = self.workbook.add_worksheet()
-        bold = self.workbook.add_format({"bold": True})
-
-        for col, header in enumerate(self.HEADERS):
-            self.worksheet.write(0, col, header, bold)
-
-        self.worksheet.autofilter(0, 0, 0, 6)
-
-        return (self.workbook, self.worksheet)
+        # any of "xlsx", "csv", "jsonl", "parquet" or an OutputSink instance
+        self.output_formats = output_formats
+        self.sinks = []
+        # optional SQLite database every run's results are appended to
+        self.history_db = history_db
+        # only poll the hosts of one of the shards, split by hostname or a tag
+        self.shards = shards
+        self.shard = shard
+        self.shard_by = shard_by
+        # the results of every device are appended to the journal as it completes,
+        # resuming skips the devices that are already in it
+        self.journal = None
+        if journal_file is not None:
+            self.journal = RunJournal(journal_file, resume)
+        self.resume = resume and self.journal is not None
+        # write chassis, linecard and optics rows to separate sheets
+        self.split_sheets = split_sheets
+        # path to the rpc_logs.zip (or directory) of a previous run to replay
+        self.replay = replay
+        # opened once per replay and shared by all devices, see open_replay
+        self.replay_archive = None
+        # never overwrite the archive that is being replayed
+        self.log_rpc = log_rpc and replay is None
+        # the RPC logs are streamed into archive_path during the run, it's passed
+        # through strftime so every run can get its own archive
+        self.archive_path = archive_path
+        self.archive_compression = archive_compression
+        self.archive_compresslevel = archive_compresslevel
+        self.archive = None
+        # ask the devices only for the interfaces and statements that are checked
+        self.rpc_filtering = rpc_filtering and replay is None
+        self.queue = ResultQueue()
+        # maximum number of devices polled at the same time
+        self.max_workers = max_workers
+        # optional per tag limits, e.g. {"site": {"ams": 4}, "jumphost": {"1.2.3.4": 10}}
+        self.limits = limits or {}
+        check_limits(self.limits)
+        self.host_tags = {}
+        # add fleet wide rollups per site, model, linecard type and optic speed
+        self.rollups = None
+        if rollups:
+            self.rollups = FleetRollups(self.host_tags)
+        # optional directory of cached per device results for incremental runs
+        self.cache = None
+        if cache_dir is not None and replay is None:
+            self.cache = DeviceCache(cache_dir, cache_ttl, cache_max_age)
+        self.reported_hosts = set()
+        # "threads" polls every device on its own thread, "asyncio" collects the
+        # replies from an event loop and parses them on a separate executor
+        self.engine = engine
+        self.rpc_timeout = rpc_timeout
+        # number of processes parsing the collected replies, None parses them on
+        # the collection threads
+        self.parse_processes = parse_processes
+        self.pending_parses = None
+        # per device timings and queue depth, summarized into metrics_file
+        self.metrics = RunMetrics(self.rpc_filtering)
+        self.metrics_file = metrics_file
+        # optionally profile check_bandwidth with "cprofile" or "pyinstrument"
+        self.profile = profile
+        self.profile_dir = profile_dir
+        # connection retries with backoff and SSH session reuse per jumphost
+        self.connections = ConnectionManager(
+            self.host_tags,
+            connect_retries,
+            retry_backoff,
+            ssh_control_dir,
+            ssh_control_persist,
+            credentials,
+        )
+        # number of times a failed host is retried at the end of the queue
+        self.host_retries = host_retries
+        self.attempts = defaultdict(int)
+        # maximum number of seconds a run may spend collecting
+        self.deadline = deadline
+        self.failed_hosts = {}
+
+    def initialize_outputs(self):
+        base_name = os.path.splitext(self.DATA_FILENAME)[0]
+        if os.path.dirname(base_name):
+            os.makedirs(os.path.dirname(base_name), exist_ok=True)
+        for output in self.output_formats:
+            if isinstance(output, str):
+                if output == "xlsx":
+                    output = XlsxSink(self.DATA_FILENAME, self.split_sheets)
+                else:
+                    output = OUTPUT_SINKS[output](base_name)
+            output.open(self.HEADERS)
+            self.sinks.append(output)
+
+        if self.history_db is not None:
+            history = HistorySink(self.history_db, self.host_tags)
+            history.open(self.HEADERS)
+            self.sinks.append(history)
+
+        if self.rollups is not None:
+            self.rollups.open(self.HEADERS)
+            self.sinks.append(self.rollups)
+
+        return self.sinks
+
+    def close_outputs(self):
+        if self.rollups is not None:
+            rollup_start = perf_counter()
+            for name, headers, rows in self.rollups.tables():
+                for sink in self.sinks:
+                    sink.write_table(name, headers, rows)
+            self.metrics.record_run("rollups", perf_counter() - rollup_start)
+        for sink in self.sinks:
+            sink.close()
+
+    def _write_row(self, kind, values):
+        for sink in self.sinks:
+            sink.write_row(kind, values)
 
     def get_devices(self):
-        with open("hosts.yaml") as hosts:
+        with open(self.HOSTS_FILE) as hosts:
             try:
-                host_list = yaml.safe_load(hosts)
-                host_list = host_list["hosts"]
+                host_data = yaml.safe_load(hosts)
+                host_list = host_data["hosts"]
+                limits = host_data.get("limits") or {}
             except yaml.YAMLError as e:
                 print(e)
                 host_list = []
+                limits = {}
+
+        # limits passed to the constructor take precedence over hosts.yaml
+        check_limits(limits)
+        for tag, tag_limits in limits.items():
+            self.limits.setdefault(tag, {})
+            for value, limit in tag_limits.items():
+                self.limits[tag].setdefault(value, limit)
+
+        # hosts can either be a plain hostname or a mapping with optional tags
+        # e.g. {"host": "fpr2b", "site": "ams", "jumphost": "1.2.3.4"}
+        device_list = []
+        for host in host_list:
+            if isinstance(host, dict):
+                device_name = host["host"]
+                self.host_tags[device_name] = {
+                    tag: value for tag, value in host.items() if tag != "host"
+                }
+            else:
+                device_name = host
+            device_list.append(device_name)
 
-        return host_list
+        return device_list
 
-    def get_capacity_usage(self):
-        device_list = self.get_devices()
+    def get_replay_devices(self):
+        archive = ArchiveDevice(None, self.replay_archive)
+        return archive.list_hosts()
+
+    def record_failure(self, device_name, reason, scheduler=None):
+        """
+        Sends a failed host to the back of the scheduler's queue until it runs out
+        of retries, then records why it failed
+        """
+        print(f"Failed to check {device_name}: {reason}")
+        self.attempts[device_name] += 1
+        if (
+            scheduler is not None
+            and reason != "ConnectAuthError"
+            and self.attempts[device_name] <= self.host_retries
+        ):
+            scheduler.retry(device_name)
+            return
+        self.failed_hosts[device_name] = reason
+        self.metrics.record_failure(device_name, reason)
 
-        workbook, worksheet = self.initialize_workbook()
+    def _poll_devices(self, scheduler):
+        while True:
+            device_name = scheduler.next_host()
+            if device_name is None:
+                break
+            device = None
+            failure = None
+            try:
+                # create the device lazily so only active workers hold a session
+                source = None
+                if self.replay is not None:
+                    source = ArchiveDevice(device_name, self.replay_archive)
+                device = JunosDevice(
+                    device_name,
+                    self.queue,
+                    self.log_rpc,
+                    source,
+                    self.cache,
+                    self.connections,
+                    self.archive,
+                    self.rpc_filtering,
+                )
+                run_profiled(
+                    device.check_bandwidth, device_name, self.profile, self.profile_dir
+                )
+                if not device.reported:
+                    failure = device.failure or "not reported"
+            except Exception as e:
+                # a reported device is in the report already, it must not be retried
+                if device is None or not device.reported:
+                    failure = failure_reason(e)
+                if device is not None:
+                    device.close_quietly()
+            finally:
+                scheduler.release(device_name)
+                # reported devices hand their timings to the writer with the entry
+                if device is not None and not device.reported:
+                    self.metrics.record_device(device_name, device.timings)
+
+            if failure is not None:
+                self.record_failure(device_name, failure, scheduler)
+
+    def _collect_devices(self, scheduler, parse_pool):
+        # first stage, only collect the raw replies and leave parsing to the pool
+        while True:
+            device_name = scheduler.next_host()
+            if device_name is None:
+                break
+            device = None
+            collected = None
+            failure = None
+            try:
+                source = None
+                if self.replay is not None:
+                    source = ArchiveDevice(device_name, self.replay_archive)
+                device = JunosDevice(
+                    device_name,
+                    self.queue,
+                    self.log_rpc,
+                    source,
+                    self.cache,
+                    self.connections,
+                    self.archive,
+                    self.rpc_filtering,
+                )
+                collected = device.collect_replies()
+                if collected is None:
+                    failure = device.failure or "not collected"
+            except Exception as e:
+                failure = failure_reason(e)
+            finally:
+                scheduler.release(device_name)
+
+            if collected is None:
+                if device is not None:
+                    self.metrics.record_device(device_name, device.timings)
+                self.record_failure(device_name, failure, scheduler)
+                continue
+
+            # don't let collected replies pile up when parsing falls behind
+            self.pending_parses.acquire()
+            future = parse_pool.submit(
+                parse_collected_replies,
+                device_name,
+                collected.replies,
+                self.cache,
+                collected.timings,
+                self.profile,
+                self.profile_dir,
+                collected.cache_lookup,
+            )
+            future.add_done_callback(partial(self._parsed, device_name))
+
+    def _parsed(self, device_name, future):
+        self.pending_parses.release()
+        try:
+            entry = future.result()
+        except Exception as e:
+            # parsing the same replies again would fail the same way
+            self.metrics.record_device(device_name, {})
+            self.record_failure(device_name, failure_reason(e))
+            return
+        if entry is not None:
+            self.queue.put(entry)
+
+    def open_replay(self):
+        """
+        Opens the replayed archive once, reopening it for every reply makes
+        replays slower with every device in the archive
+        """
+        self.replay_archive = self.replay
+        if not os.path.isdir(self.replay):
+            self.replay_archive = ZipFile(self.replay)
+
+    def close_replay(self):
+        if isinstance(self.replay_archive, ZipFile):
+            self.replay_archive.close()
+        self.replay_archive = None
+
+    def get_capacity_usage(self):
+        if self.replay is not None:
+            self.open_replay()
+            device_list = self.get_replay_devices()
+        else:
+            device_list = self.get_devices()
+        # the cache can be shared by the shards, keep the entries of all of them
+        cached_hosts = device_list
+        if self.shard is not None:
+            device_list = shard_hosts(
+                device_list, self.host_tags, self.shards, self.shard_by
+            )[self.shard]
+        pending = device_list
+        if self.journal is not None:
+            self.journal.open()
+            pending = [
+                device_name
+                for device_name in device_list
+                if device_name not in self.journal.entries
+            ]
+
+        self.metrics.start()
+        deadline = None
+        if self.deadline is not None:
+            deadline = perf_counter() + self.deadline
+        self.connections.deadline = deadline
+        if self.log_rpc:
+            self.archive = RpcArchive(
+                strftime(self.archive_path),
+                self.archive_compression,
+                self.archive_compresslevel,
+            )
+            # keep the RPC logs of the devices a resumed run doesn't poll again
+            self.archive.open(self.journal.entries if self.resume else None)
+        self.initialize_outputs()
         writer_thread = Thread(target=self.write_data, args=(), daemon=True)
         writer_thread.start()
+        if self.journal is not None:
+            for device_name in device_list:
+                if device_name in self.journal.entries:
+                    self.queue.put(self.journal.entries[device_name])
+
+        if self.engine == "asyncio" and self.replay is None:
+            collector = AsyncCollector(self, self.max_workers, self.rpc_timeout)
+            collector.run(pending, deadline)
+        elif self.parse_processes is not None:
+            scheduler = HostScheduler(pending, self.host_tags, self.limits, deadline)
+            self.pending_parses = BoundedSemaphore(self.max_workers)
+            with ProcessPoolExecutor(self.parse_processes) as parse_pool:
+                threads = [
+                    Thread(
+                        target=self._collect_devices,
+                        args=(scheduler, parse_pool),
+                        daemon=True,
+                    )
+                    for _ in range(min(self.max_workers, len(pending)))
+                ]
+                self._run_threads(threads, deadline)
+        else:
+            scheduler = HostScheduler(pending, self.host_tags, self.limits, deadline)
+            threads = [
+                Thread(target=self._poll_devices, args=(scheduler,), daemon=True)
+                for _ in range(min(self.max_workers, len(pending)))
+            ]
+            self._run_threads(threads, deadline)
+        # workers left behind at the deadline can't add entries after this
+        self.queue.close()
+        self.queue.join()
+        if self.replay is not None:
+            self.close_replay()
+        if self.journal is not None:
+            self.journal.close()
+        self.metrics.record_run("collection", self.metrics.elapsed())
+
+        # hosts still pending or in flight when the deadline passed
+        for device_name in device_list:
+            if (
+                device_name not in self.reported_hosts
+                and device_name not in self.failed_hosts
+            ):
+                reason = "not reported"
+                if deadline is not None and perf_counter() >= deadline:
+                    reason = "deadline reached"
+                self.failed_hosts[device_name] = reason
+                self.metrics.record_failure(device_name, reason)
 
-        devices = [
-            JunosDevice(device_name, self.queue, self.log_rpc)
-            for device_name in device_list
-        ]
-        threads = [Thread(target=device.check_bandwidth, args=()) for device in devices]
+        if self.cache is not None:
+            self.cache.evict(cached_hosts)
+
+        if self.log_rpc:
+            archive_start = perf_counter()
+            # Add missing devices to separate file
+            missing_devices = [
+                f"{device_name}: {self.failed_hosts[device_name]}"
+                for device_name in device_list
+                if device_name in self.failed_hosts
+            ]
+            missing_file = os.path.join(
+                os.path.dirname(self.DATA_FILENAME), "missing_devices.txt"
+            )
+            with open(missing_file, "w") as missing:
+                missing.write("\n".join(missing_devices))
+            self.archive.close(missing_devices)
+            self.metrics.record_run("archive", perf_counter() - archive_start)
+
+        flush_start = perf_counter()
+        self.close_outputs()
+        self.metrics.record_run("flush", perf_counter() - flush_start)
+
+        if self.metrics_file is not None:
+            self.metrics.record_run("total", self.metrics.elapsed())
+            self.metrics.write(self.metrics_file, self.reported_hosts)
+
+    def merge_shards(self):
+        """
+        Combines the JSONL results and RPC logs of every shard into this run's
+        outputs and archive
+        """
+        # the history and rollups need the tags of the hosts
+        device_list = self.get_devices()
+        self.initialize_outputs()
+        missing_devices = []
+        for shard in range(self.shards):
+            directory = shard_directory(self.DATA_FILENAME, shard)
+            base_name = os.path.splitext(os.path.basename(self.DATA_FILENAME))[0]
+            results_file = os.path.join(directory, f"{base_name}.jsonl")
+            if not os.path.exists(results_file):
+                # the shard failed or its results weren't copied back
+                hosts = shard_hosts(
+                    device_list, self.host_tags, self.shards, self.shard_by
+                )[shard]
+                print(f"No results of shard {shard} in {directory}")
+                missing_devices.extend(
+                    f"{host}: shard {shard} missing" for host in hosts
+                )
+                continue
+            with open(results_file) as results:
+                for line in results:
+                    record = json.loads(line)
+                    kind = record.pop("record")
+                    # put the values back in the columns they came from
+                    columns = OutputSink.COLUMNS[kind]
+                    values = [None] * (max(columns) + 1)
+                    for column in columns:
+                        values[column] = record[self.HEADERS[column]]
+                    self._write_row(kind, values)
+
+            missing_file = os.path.join(directory, "missing_devices.txt")
+            if os.path.exists(missing_file):
+                with open(missing_file) as missing:
+                    missing_devices.extend(missing.read().splitlines())
+        self.close_outputs()
+
+        if self.log_rpc:
+            archive = RpcArchive(
+                strftime(self.archive_path),
+                self.archive_compression,
+                self.archive_compresslevel,
+            )
+            archive.open()
+            for shard in range(self.shards):
+                path = os.path.join(
+                    shard_directory(self.DATA_FILENAME, shard), "rpc_logs.zip"
+                )
+                if os.path.exists(path):
+                    archive.copy(path)
+            missing_file = os.path.join(
+                os.path.dirname(self.DATA_FILENAME), "missing_devices.txt"
+            )
+            with open(missing_file, "w") as missing:
+                missing.write("\n".join(missing_devices))
+            archive.close(missing_devices)
+
+    def _run_threads(self, threads, deadline=None):
         for thread in threads:
             thread.start()
+        # devices that are still busy at the deadline are left behind
         for thread in threads:
-            thread.join()
-        self.queue.put(None)
-        self.queue.join()
-
-        if self.log_rpc:
-            with ZipFile(f"rpc_logs.zip", "w") as zip_file:
-                missing_devices = []
-                for device_name in device_list:
-                    try:
-                        zip_file.write(f"{device_name}_interface_config.xml")
-                        zip_file.write(f"{device_name}_interface_media.xml")
-                        zip_file.write(f"{device_name}_chassis_hardware.xml")
-                        os.remove(f"{device_name}_interface_config.xml")
-                        os.remove(f"{device_name}_interface_media.xml")
-                        os.remove(f"{device_name}_chassis_hardware.xml")
-
-                    except FileNotFoundError as e:
-                        # Add missing devices to separate file
-                        missing_devices.append(device_name)
-                with open("missing_devices.txt", "w") as missing:
-                    missing.write("\n".join(missing_devices))
-                zip_file.write("missing_devices.txt")
-
-        worksheet.autofit()
-        workbook.close()
+            if deadline is None:
+                thread.join()
+            else:
+                thread.join(max(0, deadline - perf_counter()))
 
     def write_data(self):
         while True:
@@ -115,19 +851,16 @@ class Capacity:
                 self.queue.task_done()
                 break
 
-            col = 0
-            for value in entry["chassis"]:
-                self.worksheet.write(self.entry_row, col, value)
-                col += 1
-            self.entry_row += 1
+            self.metrics.sample_queue_depth(self.queue.qsize())
+            write_start = perf_counter()
+            timings = entry.pop("timings", {})
+            host = entry["chassis"][0]
+            self.reported_hosts.add(host)
+            self._write_row("chassis", entry["chassis"])
 
             for _, info in entry["linecards"].items():
                 # Iterate over linecard details first
-                col = 0
-                for value in info["details"]:
-                    self.worksheet.write(self.entry_row, col, value)
-                    col += 1
-                self.entry_row += 1
+                self._write_row("linecards", info["details"])
 
                 # Iterate over each PIC
                 for pic, xcvrs in info["interfaces"].items():
@@ -140,40 +873,1822 @@ class Capacity:
                             serial = xcvr_details["serial"]
                             speed = xcvr_details["speed"]
 
-                            self.worksheet.write(
-                                self.entry_row, 0, entry["chassis"][0]
-                            )  # host
-                            self.worksheet.write(self.entry_row, 2, name)
-                            self.worksheet.write(self.entry_row, 3, model)
-                            self.worksheet.write(self.entry_row, 4, serial)
-                            self.worksheet.write(self.entry_row, 5, speed)
-                            self.entry_row += 1
+                            self._write_row(
+                                "optics", [host, None, name, model, serial, speed]
+                            )
 
+            if self.journal is not None and host not in self.journal.entries:
+                if self.archive is not None:
+                    self.archive.sync(host)
+                self.journal.record(host, entry)
+            timings["write"] = perf_counter() - write_start
+            self.metrics.record_device(host, timings)
             self.queue.task_done()
 
 
+class OutputSink:
+    """
+    Receives every report row from the writer thread, rows are tagged with their
+    kind (chassis, linecards or optics) and line up with Capacity.HEADERS
+    """
+
+    # the columns that are filled in for each kind of row
+    COLUMNS = {
+        "chassis": list(range(13)),
+        "linecards": list(range(10)),
+        "optics": [0, 2, 3, 4, 5],
+    }
+
+    def open(self, headers):
+        self.headers = headers
+
+    def write_row(self, kind, values):
+        raise NotImplementedError
+
+    def write_table(self, name, headers, rows):
+        # summary tables, e.g. the fleet rollups, are skipped by default
+        pass
+
+    def close(self):
+        pass
+
+    def _columns(self, kind):
+        return [self.headers[col] for col in self.COLUMNS[kind]]
+
+    def _project(self, kind, values):
+        return [
+            values[col] if col < len(values) and values[col] != "" else None
+            for col in self.COLUMNS[kind]
+        ]
+
+
+class XlsxSink(OutputSink):
+    EXCEL_MAX_ROWS = 1048576
+    SHEET_NAMES = {"chassis": "Chassis", "linecards": "Linecards", "optics": "Optics"}
+
+    def __init__(self, filename, split_sheets=False):
+        self.filename = filename
+        # write chassis, linecard and optics rows to separate sheets
+        self.split_sheets = split_sheets
+        self.workbook = None
+        self.bold = None
+        self.sheets = {}
+
+    def open(self, headers):
+        super().open(headers)
+        # rows are flushed to disk as they're written instead of kept until close()
+        self.workbook = Workbook(self.filename, {"constant_memory": True})
+        self.bold = self.workbook.add_format({"bold": True})
+
+        if self.split_sheets:
+            for kind, name in self.SHEET_NAMES.items():
+                self.sheets[kind] = self._add_worksheet(name)
+        else:
+            sheet = self._add_worksheet(None)
+            for kind in self.SHEET_NAMES:
+                self.sheets[kind] = sheet
+
+    def _add_worksheet(self, name, part=1):
+        sheet_name = name
+        if name is not None and part > 1:
+            sheet_name = f"{name} ({part})"
+        worksheet = self.workbook.add_worksheet(sheet_name)
+        worksheet.write_row(0, 0, self.headers, self.bold)
+        worksheet.autofilter(0, 0, 0, 6)
+
+        return {
+            "name": name,
+            "part": part,
+            "worksheet": worksheet,
+            "row": 1,
+            "widths": [len(header) for header in self.headers],
+        }
+
+    def write_row(self, kind, values):
+        sheet = self.sheets[kind]
+        if sheet["row"] >= self.EXCEL_MAX_ROWS:
+            # continue on a new sheet once Excel's row limit is reached
+            self._set_column_widths(sheet)
+            sheet.update(self._add_worksheet(sheet["name"], sheet["part"] + 1))
+
+        sheet["worksheet"].write_row(sheet["row"], 0, values)
+        sheet["row"] += 1
+
+        widths = sheet["widths"]
+        for col, value in enumerate(values):
+            if value is not None and len(str(value)) > widths[col]:
+                widths[col] = len(str(value))
+
+    def write_table(self, name, headers, rows):
+        worksheet = self.workbook.add_worksheet(name)
+        worksheet.write_row(0, 0, headers, self.bold)
+        widths = [len(header) for header in headers]
+        for row_number, row in enumerate(rows, 1):
+            worksheet.write_row(row_number, 0, row)
+            for col, value in enumerate(row):
+                if value is not None and len(str(value)) > widths[col]:
+                    widths[col] = len(str(value))
+        for col, width in enumerate(widths):
+            worksheet.set_column(col, col, width + 2)
+
+    def _set_column_widths(self, sheet):
+        # autofit() needs the whole sheet in memory, size the columns as we go instead
+        for col, width in enumerate(sheet["widths"]):
+            sheet["worksheet"].set_column(col, col, width + 2)
+
+    def close(self):
+        for sheet in {id(sheet): sheet for sheet in self.sheets.values()}.values():
+            self._set_column_widths(sheet)
+        self.workbook.close()
+
+
+class CsvSink(OutputSink):
+    """
+    Writes one CSV file per kind of row, e.g. bandwidth_data_optics.csv
+    """
+
+    def __init__(self, base_name):
+        self.base_name = base_name
+        self.files = {}
+        self.writers = {}
+
+    def open(self, headers):
+        super().open(headers)
+        for kind in self.COLUMNS:
+            self.files[kind] = open(f"{self.base_name}_{kind}.csv", "w", newline="")
+            self.writers[kind] = csv.writer(self.files[kind])
+            self.writers[kind].writerow(self._columns(kind))
+
+    def write_row(self, kind, values):
+        self.writers[kind].writerow(self._project(kind, values))
+
+    def write_table(self, name, headers, rows):
+        table_name = name.lower().replace(" ", "_")
+        with open(f"{self.base_name}_{table_name}.csv", "w", newline="") as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(headers)
+            writer.writerows(rows)
+
+    def close(self):
+        for csv_file in self.files.values():
+            csv_file.close()
+
+
+class JsonlSink(OutputSink):
+    """
+    Writes every row as a JSON object to a single newline delimited file with
+    the kind of row stored in the "record" field
+    """
+
+    def __init__(self, base_name):
+        self.filename = f"{base_name}.jsonl"
+        self.file = None
+
+    def open(self, headers):
+        super().open(headers)
+        self.file = open(self.filename, "w")
+
+    def write_row(self, kind, values):
+        record = {"record": kind}
+        record.update(zip(self._columns(kind), self._project(kind, values)))
+        self.file.write(json.dumps(record, default=str) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetSink(OutputSink):
+    """
+    Writes one Parquet file per kind of row in batches, requires pyarrow
+    """
+
+    BATCH_SIZE = 10000
+    STRING_COLUMNS = ["Hostname", "Version", "Hardware", "Model", "Serial"]
+
+    def __init__(self, base_name):
+        self.base_name = base_name
+        self.writers = {}
+        self.batches = {}
+        self.schemas = {}
+
+    def open(self, headers):
+        super().open(headers)
+        # pyarrow is only needed when Parquet output is requested
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pyarrow = pyarrow
+        for kind in self.COLUMNS:
+            self.schemas[kind] = pyarrow.schema(
+                [
+                    (
+                        column,
+                        (
+                            pyarrow.string()
+                            if column in self.STRING_COLUMNS
+                            else pyarrow.int64()
+                        ),
+                    )
+                    for column in self._columns(kind)
+                ]
+            )
+            self.writers[kind] = pyarrow.parquet.ParquetWriter(
+                f"{self.base_name}_{kind}.parquet", self.schemas[kind]
+            )
+            self.batches[kind] = []
+
+    def write_row(self, kind, values):
+        row = []
+        for column, value in zip(self._columns(kind), self._project(kind, values)):
+            # speeds of unused optics are reported as N/A
+            if column not in self.STRING_COLUMNS and not isinstance(value, int):
+                value = None
+            elif column in self.STRING_COLUMNS and value is not None:
+                value = str(value)
+            row.append(value)
+
+        self.batches[kind].append(row)
+        if len(self.batches[kind]) >= self.BATCH_SIZE:
+            self._flush(kind)
+
+    def _flush(self, kind):
+        if self.batches[kind]:
+            columns = list(zip(*self.batches[kind]))
+            self.writers[kind].write_table(
+                self.pyarrow.Table.from_arrays(
+                    [
+                        self.pyarrow.array(column, field.type)
+                        for column, field in zip(columns, self.schemas[kind])
+                    ],
+                    schema=self.schemas[kind],
+                )
+            )
+            self.batches[kind] = []
+
+    def close(self):
+        for kind, writer in self.writers.items():
+            self._flush(kind)
+            writer.close()
+
+
+class HistorySink(OutputSink):
+    """
+    Appends the rows of every run to a SQLite database so the capacity can be
+    followed across runs, see HISTORY_QUERIES
+    """
+
+    BATCH_SIZE = 10000
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id INTEGER PRIMARY KEY, run_time TEXT NOT NULL, devices INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS chassis (
+            run_id INTEGER, run_time TEXT, host TEXT, site TEXT, version TEXT,
+            model TEXT, serial TEXT, ports_in_use INTEGER, ports_installed INTEGER,
+            capacity INTEGER, used INTEGER, available INTEGER, remaining INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS linecards (
+            run_id INTEGER, run_time TEXT, host TEXT, slot TEXT, version TEXT,
+            model TEXT, serial TEXT, channelized_ports INTEGER, ports_in_use INTEGER,
+            ports_installed INTEGER, capacity INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS transceivers (
+            run_id INTEGER, run_time TEXT, host TEXT, slot TEXT, port TEXT,
+            channel INTEGER, model TEXT, serial TEXT, speed INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS chassis_host ON chassis (host, run_id);
+        CREATE INDEX IF NOT EXISTS chassis_run_time ON chassis (run_time);
+        CREATE INDEX IF NOT EXISTS chassis_model ON chassis (model);
+        CREATE INDEX IF NOT EXISTS linecards_host ON linecards (host, run_id);
+        CREATE INDEX IF NOT EXISTS linecards_run_time ON linecards (run_time);
+        CREATE INDEX IF NOT EXISTS linecards_model ON linecards (model);
+        CREATE INDEX IF NOT EXISTS transceivers_host
+            ON transceivers (host, run_id, slot, port);
+        CREATE INDEX IF NOT EXISTS transceivers_run_time ON transceivers (run_time);
+        CREATE INDEX IF NOT EXISTS transceivers_model ON transceivers (model);
+        CREATE INDEX IF NOT EXISTS transceivers_speed ON transceivers (speed);
+    """
+    INSERTS = {
+        "chassis": "INSERT INTO chassis VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        "linecards": "INSERT INTO linecards VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        "optics": "INSERT INTO transceivers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+    }
+
+    def __init__(self, path, host_tags=None):
+        self.path = path
+        self.host_tags = host_tags if host_tags is not None else {}
+        self.connection = None
+        self.run_id = None
+        self.run_time = None
+        self.devices = 0
+        # optics rows follow the row of the linecard they're installed in
+        self.slot = None
+        self.batches = {kind: [] for kind in self.INSERTS}
+
+    def open(self, headers):
+        super().open(headers)
+        # rows are written from the writer thread, one thread at a time
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.executescript(self.SCHEMA)
+        self.run_time = strftime("%Y-%m-%dT%H:%M:%S")
+        self.run_id = self.connection.execute(
+            "INSERT INTO runs (run_time) VALUES (?)", (self.run_time,)
+        ).lastrowid
+
+    def _integer(self, value):
+        # speeds of unused optics are reported as N/A
+        return value if isinstance(value, int) else None
+
+    def write_row(self, kind, values):
+        host = values[0]
+        if kind == "chassis":
+            self.devices += 1
+            site = self.host_tags.get(host, {}).get("site")
+            row = [host, site, values[1], values[3], values[4]]
+            row += [self._integer(value) for value in values[7:13]]
+        elif kind == "linecards":
+            self.slot = values[2]
+            row = [host, values[2], values[1], values[3], values[4]]
+            row += [self._integer(value) for value in values[6:10]]
+        else:
+            port, _, channel = values[2].partition(":")
+            row = [host, self.slot, port, int(channel) if channel else None]
+            row += [values[3], values[4], self._integer(values[5])]
+
+        self.batches[kind].append([self.run_id, self.run_time] + row)
+        if len(self.batches[kind]) >= self.BATCH_SIZE:
+            self._flush(kind)
+
+    def _flush(self, kind):
+        if self.batches[kind]:
+            self.connection.executemany(self.INSERTS[kind], self.batches[kind])
+            self.batches[kind] = []
+
+    def close(self):
+        for kind in self.batches:
+            self._flush(kind)
+        self.connection.execute(
+            "UPDATE runs SET devices = ? WHERE run_id = ?", (self.devices, self.run_id)
+        )
+        self.connection.commit()
+        self.connection.close()
+
+
+class FleetRollups(OutputSink):
+    """
+    Keeps every port of the run in columnar arrays and rolls them up per site,
+    chassis model, linecard type and optic speed class once all devices are in,
+    the rollups are added to the report as extra sheets. Requires numpy and pandas
+    """
+
+    SPEED_CLASS = r"(\d+)G"
+    COUNTS = [
+        "Ports Installed",
+        "Ports In Use",
+        "Free Ports",
+        "Channelized Ports",
+        "Used (gbps)",
+    ]
+
+    def __init__(self, host_tags=None):
+        self.host_tags = host_tags if host_tags is not None else {}
+        self.chassis = []
+        # sites, linecard types and optic models are stored as codes into these
+        self.sites = {}
+        self.linecard_types = {}
+        self.optic_models = {}
+        # typed arrays are handed to numpy without copying them
+        self.linecard_site = array("q")
+        self.linecard_type = array("q")
+        self.port_linecard = array("q")
+        self.port_optic = array("q")
+        self.channel_port = array("q")
+        self.channel_speed = array("q")
+        self.channel_split = array("q")
+        # optics rows follow the row of the linecard they're installed in
+        self.port = None
+
+    def open(self, headers):
+        super().open(headers)
+        # numpy and pandas are only needed when the rollups are requested
+        import numpy
+        import pandas
+
+        self.numpy = numpy
+        self.pandas = pandas
+
+    def _code(self, codes, name):
+        return codes.setdefault(name, len(codes))
+
+    def _integer(self, value):
+        # speeds of unused optics are reported as N/A
+        return value if isinstance(value, int) else 0
+
+    def write_row(self, kind, values):
+        if kind == "chassis":
+            site = self.host_tags.get(values[0], {}).get("site") or "N/A"
+            self.chassis.append(
+                [site, values[3]] + [self._integer(value) for value in values[7:13]]
+            )
+        elif kind == "linecards":
+            self.linecard_site.append(self._code(self.sites, self.chassis[-1][0]))
+            self.linecard_type.append(self._code(self.linecard_types, values[3]))
+            self.port = None
+        else:
+            port, _, channel = values[2].partition(":")
+            if port != self.port:
+                self.port = port
+                self.port_linecard.append(len(self.linecard_type) - 1)
+                self.port_optic.append(self._code(self.optic_models, values[3]))
+            self.channel_port.append(len(self.port_optic) - 1)
+            self.channel_speed.append(self._integer(values[5]))
+            self.channel_split.append(bool(channel))
+
+    def _array(self, values):
+        return self.numpy.frombuffer(values, dtype=self.numpy.int64)
+
+    def _rows(self, frame):
+        frame = frame.astype(object).where(frame.notna(), None)
+        return frame.to_numpy().tolist()
+
+    def site_rollup(self):
+        chassis = self.pandas.DataFrame(
+            self.chassis,
+            columns=["Site", "Model"] + self.headers[7:13],
+        )
+        rollup = chassis.groupby(["Site", "Model"], sort=True).agg(
+            Devices=("Model", "size"),
+            **{column: (column, "sum") for column in self.headers[7:13]},
+        )
+        rollup["Port Usage"] = (
+            rollup["Ports In Use"] / rollup["Ports Installed"].where(lambda x: x > 0)
+        ).round(3)
+        rollup["License Usage"] = (
+            rollup["Used (gbps)"] / rollup["Available (gbps)"].where(lambda x: x > 0)
+        ).round(3)
+        return rollup.reset_index()
+
+    def speed_classes(self):
+        # the nominal speed of every optic model, e.g. 100G for QSFP-100GBASE-SR4
+        models = self.pandas.Series(list(self.optic_models), dtype=object)
+        speeds = models.str.extract(self.SPEED_CLASS, expand=False)
+        codes, classes = self.pandas.factorize((speeds + "G").fillna("N/A"))
+        return codes, list(classes)
+
+    def ports(self):
+        """
+        Returns the site, linecard type and speed class codes of every port with
+        the port counts it adds to them, a port is in use when any of its channels
+        is and channelized when it's split into channels
+        """
+        numpy = self.numpy
+        ports = len(self.port_optic)
+        channel_port = self._array(self.channel_port)
+        speed = self._array(self.channel_speed)
+        used = numpy.bincount(channel_port, speed > 0, ports) > 0
+        split = numpy.bincount(channel_port, self._array(self.channel_split), ports)
+        port_linecard = self._array(self.port_linecard)
+        speed_classes, classes = self.speed_classes()
+        keys = {
+            "Site": (self._array(self.linecard_site)[port_linecard], list(self.sites)),
+            "Linecard Type": (
+                self._array(self.linecard_type)[port_linecard],
+                list(self.linecard_types),
+            ),
+            "Speed Class": (speed_classes[self._array(self.port_optic)], classes),
+        }
+        counts = [
+            None,
+            used,
+            ~used,
+            split > 0,
+            numpy.bincount(channel_port, speed, ports),
+        ]
+        return keys, counts
+
+    def port_rollup(self, ports, by):
+        """
+        Sums the port counts per combination of the given keys, every combination
+        is a single code so the sums are one bincount per count over all ports
+        """
+        numpy = self.numpy
+        keys, counts = ports
+        sizes = [len(keys[column][1]) for column in by]
+        group = numpy.ravel_multi_index([keys[column][0] for column in by], sizes)
+        groups = int(numpy.prod(sizes))
+        sums = [numpy.bincount(group, count, groups) for count in counts]
+        present = numpy.flatnonzero(sums[0])
+
+        columns = {}
+        for column, codes in zip(by, numpy.unravel_index(present, sizes)):
+            columns[column] = numpy.array(keys[column][1], dtype=object)[codes]
+        for column, total in zip(self.COUNTS, sums):
+            columns[column] = total[present].astype(numpy.int64)
+        rollup = self.pandas.DataFrame(columns)
+        rollup["Channelized Ratio"] = (
+            rollup["Channelized Ports"] / rollup["Ports Installed"]
+        ).round(3)
+        return rollup.sort_values(by, ignore_index=True)
+
+    def tables(self):
+        if not self.chassis:
+            return []
+        sites = self.site_rollup()
+        ports = self.ports()
+        linecards = self.port_rollup(ports, ["Linecard Type"])
+        linecard_counts = self.numpy.bincount(self._array(self.linecard_type))
+        linecards.insert(
+            1,
+            "Linecards",
+            [
+                linecard_counts[self.linecard_types[name]]
+                for name in linecards["Linecard Type"]
+            ],
+        )
+        speeds = self.port_rollup(ports, ["Site", "Speed Class"])
+        return [
+            ("Site Rollup", list(sites.columns), self._rows(sites)),
+            ("Linecard Rollup", list(linecards.columns), self._rows(linecards)),
+            ("Optic Speed Rollup", list(speeds.columns), self._rows(speeds)),
+        ]
+
+
+# canned queries over the history database, parameters are passed by name
+HISTORY_QUERIES = {
+    # devices and totals of every run
+    "runs": """
+        SELECT run_id, run_time, COUNT(*) AS devices, SUM(capacity) AS capacity,
+            SUM(used) AS used, SUM(available) AS available
+        FROM chassis GROUP BY run_id ORDER BY run_id
+    """,
+    # the last run every chassis used at least threshold of its licensed bandwidth
+    "license-usage": """
+        SELECT host, site, MAX(run_time) AS run_time, used, available,
+            ROUND(1.0 * used / available, 3) AS ratio
+        FROM chassis
+        WHERE available > 0 AND used >= :threshold * available
+            AND run_time >= :since
+        GROUP BY host ORDER BY ratio DESC
+    """,
+    # unused optics per site and model in the latest run of every chassis
+    "free-ports": """
+        WITH latest AS (
+            SELECT host, MAX(run_id) AS run_id FROM chassis
+            WHERE run_time >= :since GROUP BY host
+        )
+        SELECT chassis.site, transceivers.model, COUNT(*) AS free_ports
+        FROM latest
+        JOIN chassis ON chassis.host = latest.host AND chassis.run_id = latest.run_id
+        JOIN transceivers ON transceivers.host = latest.host
+            AND transceivers.run_id = latest.run_id
+        WHERE transceivers.speed IS NULL AND transceivers.channel IS NULL
+            AND NOT EXISTS (
+                SELECT 1 FROM transceivers AS channels
+                WHERE channels.host = transceivers.host
+                    AND channels.run_id = transceivers.run_id
+                    AND channels.slot = transceivers.slot
+                    AND channels.port = transceivers.port
+                    AND channels.channel IS NOT NULL
+            )
+        GROUP BY chassis.site, transceivers.model
+        ORDER BY chassis.site, free_ports DESC
+    """,
+}
+
+
+def query_history(path, query, threshold=0.8, since=""):
+    """
+    Runs one of the HISTORY_QUERIES or a raw SQL statement against the history
+    database, returns the column names and the rows
+    """
+    sql = HISTORY_QUERIES.get(query, query)
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        cursor = connection.execute(sql, {"threshold": threshold, "since": since})
+        columns = [column[0] for column in cursor.description]
+        return columns, cursor.fetchall()
+    finally:
+        connection.close()
+
+
+OUTPUT_SINKS = {
+    "xlsx": XlsxSink,
+    "csv": CsvSink,
+    "jsonl": JsonlSink,
+    "parquet": ParquetSink,
+}
+
+
+class RunMetrics:
+    """
+    Collects the per device timings (connect, RPCs, parsing and writing), reply
+    sizes and the depth of the writer queue, and summarizes them as JSON at the
+    end of a run
+    """
+
+    def __init__(self, rpc_filtering=False):
+        self.rpc_filtering = rpc_filtering
+        self.lock = Lock()
+        self.start_time = perf_counter()
+        self.devices = {}
+        self.queue_depths = []
+        self.run_timings = {}
+        self.failures = {}
+
+    def start(self):
+        self.start_time = perf_counter()
+
+    def elapsed(self):
+        return perf_counter() - self.start_time
+
+    def record_device(self, device_name, timings):
+        with self.lock:
+            device_timings = self.devices.setdefault(device_name, {})
+            for stage, seconds in timings.items():
+                device_timings[stage] = device_timings.get(stage, 0) + seconds
+
+    def record_failure(self, device_name, reason):
+        self.failures[device_name] = reason
+
+    def record_run(self, stage, seconds):
+        self.run_timings[stage] = seconds
+
+    def sample_queue_depth(self, depth):
+        self.queue_depths.append(depth)
+
+    def _distribution(self, values):
+        values = sorted(values)
+        if not values:
+            return {"count": 0}
+
+        def percentile(percent):
+            # nearest rank
+            return values[max(0, -(-len(values) * percent // 100) - 1)]
+
+        return {
+            "count": len(values),
+            "total": sum(values),
+            "mean": sum(values) / len(values),
+            "p50": percentile(50),
+            "p90": percentile(90),
+            "p99": percentile(99),
+            "max": values[-1],
+        }
+
+    def _split(self, timings):
+        # reply sizes are recorded next to the timings as bytes:<rpc>
+        seconds = {}
+        sizes = {}
+        for stage, value in timings.items():
+            if stage.startswith("bytes:"):
+                sizes[stage[len("bytes:") :]] = value
+            else:
+                seconds[stage] = value
+        return seconds, sizes
+
+    def summary(self, reported_hosts=(), slowest=10):
+        stages = defaultdict(list)
+        rpc_bytes = defaultdict(list)
+        device_totals = []
+        for device_name, timings in self.devices.items():
+            seconds, sizes = self._split(timings)
+            for stage, value in seconds.items():
+                stages[stage].append(value)
+            for rpc, size in sizes.items():
+                rpc_bytes[rpc].append(size)
+            device_totals.append((sum(seconds.values()), device_name))
+        device_totals.sort(reverse=True)
+
+        return {
+            "devices": len(self.devices),
+            "rpc_filtering": self.rpc_filtering,
+            "failed": {
+                device_name: self.failures.get(device_name, "not reported")
+                for device_name in sorted(
+                    (set(self.devices) | set(self.failures)) - set(reported_hosts)
+                )
+            },
+            "run": self.run_timings,
+            "stages": {
+                stage: self._distribution(values) for stage, values in stages.items()
+            },
+            "rpc_bytes": {
+                rpc: self._distribution(sizes) for rpc, sizes in rpc_bytes.items()
+            },
+            "queue_depth": self._distribution(self.queue_depths),
+            "slowest_devices": [
+                {
+                    "host": device_name,
+                    "total": total,
+                    "timings": self._split(self.devices[device_name])[0],
+                }
+                for total, device_name in device_totals[:slowest]
+            ],
+        }
+
+    def savings(self, previous, current):
+        """
+        Bytes and seconds saved per device on every RPC compared to a previous
+        run summary, e.g. one without RPC filtering
+        """
+        savings = {}
+        for rpc, sizes in current["rpc_bytes"].items():
+            previous_sizes = previous.get("rpc_bytes", {}).get(rpc, {})
+            if "mean" not in sizes or "mean" not in previous_sizes:
+                continue
+            stage = f"rpc:{rpc}"
+            previous_seconds = previous["stages"].get(stage, {}).get("mean", 0)
+            seconds = current["stages"].get(stage, {}).get("mean", 0)
+            savings[rpc] = {
+                "bytes": previous_sizes["mean"] - sizes["mean"],
+                "seconds": previous_seconds - seconds,
+            }
+        return savings
+
+    def write(self, path, reported_hosts=()):
+        summary = self.summary(reported_hosts)
+        # compare a filtered run against the unfiltered run it replaces
+        if self.rpc_filtering and os.path.exists(path):
+            try:
+                with open(path) as summary_file:
+                    previous = json.load(summary_file)
+            except ValueError:
+                previous = {}
+            if "rpc_bytes" in previous and not previous.get("rpc_filtering"):
+                summary["rpc_filtering_savings"] = self.savings(previous, summary)
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as summary_file:
+            json.dump(summary, summary_file, indent=2)
+
+
+class DeviceCache:
+    """
+    On-disk cache of the per device results, stored as one JSON file per host.
+    Entries are served while the configuration revision and software version are
+    unchanged and the chassis inventory is younger than the TTL
+    """
+
+    def __init__(self, cache_dir=".capacity_cache", ttl=86400, max_age=604800):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        # entries that haven't been refreshed for this long are evicted
+        self.max_age = max_age
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, device_name):
+        return os.path.join(self.cache_dir, f"{device_name}.json")
+
+    def load(self, device_name):
+        try:
+            with open(self._path(device_name)) as cache_file:
+                return json.load(cache_file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, device_name, data):
+        # write to a temporary file first so an interrupted run can't corrupt the entry
+        path = self._path(device_name)
+        with open(f"{path}.tmp", "w") as cache_file:
+            json.dump(data, cache_file)
+        os.replace(f"{path}.tmp", path)
+
+    def is_fresh(self, cached):
+        return cached is not None and time() - cached["chassis_timestamp"] < self.ttl
+
+    def lookup(self, device_name, version, revision):
+        cached = self.load(device_name)
+        fresh = self.is_fresh(cached)
+        valid = (
+            fresh
+            and revision is not None
+            and cached["revision"] == revision
+            and cached["version"] == version
+        )
+        return CacheLookup(cached, revision, valid, fresh)
+
+    def evict(self, device_list):
+        # only cache entries are removed, the directory may hold other files and
+        # the entries other shards are writing to their .tmp files
+        hosts = set(device_list)
+        for cache_file in os.scandir(self.cache_dir):
+            if not cache_file.name.endswith(".json") or not cache_file.is_file():
+                continue
+            device_name = cache_file.name[: -len(".json")]
+            try:
+                if (
+                    device_name not in hosts
+                    or time() - cache_file.stat().st_mtime > self.max_age
+                ):
+                    os.remove(cache_file.path)
+            except FileNotFoundError:
+                # evicted by another shard sharing the directory
+                pass
+
+
+class RunJournal:
+    """
+    Append-only file with the results of every device, each line is flushed to
+    disk as soon as the device is written so an interrupted run can be resumed
+    without polling the devices that already completed
+    """
+
+    def __init__(self, path="capacity_journal.jsonl", resume=False):
+        self.path = path
+        self.entries = self.load() if resume else {}
+        self.file = None
+
+    def load(self):
+        entries = {}
+        try:
+            with open(self.path) as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line is cut off when the run was killed mid-write
+                        break
+                    entries[record["host"]] = record["entry"]
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # start over from the complete lines only, dropping a cut off last line
+        with open(f"{self.path}.tmp", "w") as journal:
+            for device_name, entry in self.entries.items():
+                journal.write(json.dumps({"host": device_name, "entry": entry}) + "\n")
+        os.replace(f"{self.path}.tmp", self.path)
+        self.file = open(self.path, "a")
+
+    def record(self, device_name, entry):
+        self.file.write(json.dumps({"host": device_name, "entry": entry}) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.entries[device_name] = entry
+
+    def close(self):
+        self.file.close()
+
+
+class ConnectionManager:
+    """
+    Opens the device sessions, retrying failed connections with an exponential
+    backoff, and sends the sessions of hosts tagged with a jumphost through a
+    shared SSH ControlMaster connection to that jumphost
+    """
+
+    def __init__(
+        self,
+        host_tags=None,
+        connect_retries=2,
+        retry_backoff=1,
+        ssh_control_dir=".capacity_ssh",
+        ssh_control_persist=60,
+        credentials=None,
+    ):
+        self.host_tags = host_tags if host_tags is not None else {}
+        # PyEZ Device arguments, e.g. user, password and ssh_private_key_file
+        self.credentials = credentials or {}
+        self.connect_retries = connect_retries
+        self.retry_backoff = retry_backoff
+        self.ssh_control_dir = ssh_control_dir
+        self.ssh_control_persist = ssh_control_persist
+        # perf_counter() time after which no new connection attempts are made
+        self.deadline = None
+        self.lock = Lock()
+        self.ssh_configs = {}
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return max(0, self.deadline - perf_counter())
+
+    def ssh_config(self, device_name):
+        jumphost = self.host_tags.get(device_name, {}).get("jumphost")
+        if jumphost is None or self.ssh_control_dir is None:
+            return None
+
+        # one config per jumphost, every session behind it reuses the same master
+        with self.lock:
+            if jumphost not in self.ssh_configs:
+                os.makedirs(self.ssh_control_dir, exist_ok=True)
+                control_dir = os.path.abspath(self.ssh_control_dir)
+                path = os.path.join(control_dir, f"{jumphost}.config")
+                with open(path, "w") as ssh_config:
+                    ssh_config.write(
+                        "Host *\n"
+                        "  ProxyCommand ssh -o ControlMaster=auto"
+                        f" -o ControlPath={control_dir}/%C"
+                        f" -o ControlPersist={self.ssh_control_persist}"
+                        f" -W %h:%p {jumphost}\n"
+                    )
+                self.ssh_configs[jumphost] = path
+            return self.ssh_configs[jumphost]
+
+    def device(self, device_name):
+        ssh_config = self.ssh_config(device_name)
+        if ssh_config is None:
+            return Device(host=device_name, **self.credentials)
+        return Device(host=device_name, ssh_config=ssh_config, **self.credentials)
+
+    def open(self, device):
+        for attempt in range(self.connect_retries + 1):
+            try:
+                device.open()
+                return
+            except junos_exceptions("ConnectAuthError"):
+                # retrying with the same credentials won't help
+                raise
+            except junos_exceptions("ConnectError"):
+                remaining = self.remaining()
+                if attempt == self.connect_retries or remaining == 0:
+                    raise
+                # spread out the retries of hosts behind the same flapping jumphost
+                delay = self.retry_backoff * 2**attempt * uniform(0.5, 1.5)
+                sleep(delay if remaining is None else min(delay, remaining))
+
+
+class ResultQueue(Queue):
+    """
+    Queue of the entries for the writer thread, closing it puts the stop marker
+    and drops whatever workers that were left behind at the deadline report later
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.closed = False
+        self.close_lock = Lock()
+
+    def put(self, item, block=True, timeout=None):
+        # the queue is unbounded so the lock is never held while blocking
+        with self.close_lock:
+            if not self.closed:
+                super().put(item, block, timeout)
+
+    def close(self):
+        with self.close_lock:
+            super().put(None)
+            self.closed = True
+
+
+class HostScheduler:
+    """
+    Hands out hosts to the worker threads while making sure that no more than
+    the configured number of devices are polled per tag value (site, jumphost, ...)
+    """
+
+    def __init__(self, device_list, host_tags, limits, deadline=None):
+        self.limits = limits
+        # perf_counter() time after which no more hosts are handed out
+        self.deadline = deadline
+        self.condition = Condition()
+        self.active = defaultdict(int)
+        self.pending = {}
+        self.host_keys = {}
+
+        # group the hosts by the limits that apply to them
+        for device_name in device_list:
+            tags = host_tags.get(device_name, {})
+            keys = tuple(
+                (tag, tags[tag])
+                for tag in sorted(limits)
+                if tags.get(tag) in limits[tag]
+            )
+            self.host_keys[device_name] = keys
+            self.pending.setdefault(keys, deque()).append(device_name)
+
+    def _has_capacity(self, keys):
+        for tag, value in keys:
+            if self.active[(tag, value)] >= self.limits[tag][value]:
+                return False
+        return True
+
+    def _remaining(self):
+        if self.deadline is None:
+            return None
+        return self.deadline - perf_counter()
+
+    def next_host(self):
+        with self.condition:
+            while self.pending:
+                remaining = self._remaining()
+                if remaining is not None and remaining <= 0:
+                    break
+                for keys, hosts in self.pending.items():
+                    if self._has_capacity(keys):
+                        device_name = hosts.popleft()
+                        if not hosts:
+                            del self.pending[keys]
+                        for key in keys:
+                            self.active[key] += 1
+                        return device_name
+                # every remaining host is waiting on a busy site/jumphost
+                self.condition.wait(remaining)
+            return None
+
+    def release(self, device_name):
+        with self.condition:
+            for key in self.host_keys[device_name]:
+                self.active[key] -= 1
+            self.condition.notify_all()
+
+    def retry(self, device_name):
+        # failed hosts go to the back of the queue so they don't hold up the others
+        with self.condition:
+            keys = self.host_keys[device_name]
+            self.pending.setdefault(keys, deque()).append(device_name)
+            self.condition.notify_all()
+
+
+class RpcArchive:
+    """
+    Thread-safe writer that streams the RPC replies of every device straight into
+    the rpc_logs.zip archive as they arrive, instead of zipping logs at the end.
+    Compressed archives are written by a separate thread so the workers don't
+    wait on each other's compression while holding their device sessions
+    """
+
+    # workers block once this many logs are waiting to be compressed
+    QUEUE_SIZE = 64
+    # waiting logs are kept in memory up to this size and spill to disk beyond it
+    SPOOL_SIZE = 1024 * 1024
+
+    COMPRESSION = {
+        None: zipfile.ZIP_STORED,
+        "stored": zipfile.ZIP_STORED,
+        "deflate": zipfile.ZIP_DEFLATED,
+        "bzip2": zipfile.ZIP_BZIP2,
+        "lzma": zipfile.ZIP_LZMA,
+    }
+    # zipfile supports Zstandard from Python 3.14
+    if hasattr(zipfile, "ZIP_ZSTANDARD"):
+        COMPRESSION["zstd"] = zipfile.ZIP_ZSTANDARD
+
+    def __init__(self, path="rpc_logs.zip", compression=None, compresslevel=None):
+        if compression not in self.COMPRESSION:
+            raise ValueError(
+                f"Unsupported RPC log compression {compression!r}, use one of "
+                f"{[name for name in self.COMPRESSION if name]} (zstd needs Python 3.14)"
+            )
+        self.path = path
+        self.compression = compression
+        self.compresslevel = compresslevel
+        self.lock = Lock()
+        self.zip_file = None
+        self.entries = None
+        self.writer = None
+        self.error = None
+        # number of logs per device still waiting for the writer
+        self.pending = defaultdict(int)
+        self.written = Condition(self.lock)
+        self.queued = Condition(self.lock)
+        # logs of workers left behind at the deadline are dropped once closed
+        self.closed = False
+
+    def open(self, keep_hosts=None):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        mode = "w"
+        if keep_hosts is not None and os.path.exists(self.path):
+            self.recover(keep_hosts)
+            mode = "a"
+        self.zip_file = ZipFile(
+            self.path,
+            mode,
+            compression=self.COMPRESSION[self.compression],
+            compresslevel=self.compresslevel,
+        )
+        if self.COMPRESSION[self.compression] != zipfile.ZIP_STORED:
+            self.entries = deque()
+            self.writer = Thread(target=self._write_entries, daemon=True)
+            self.writer.start()
+
+    def _write_entries(self):
+        with self.lock:
+            while True:
+                # the logs queued before closing are still written
+                self.queued.wait_for(lambda: self.entries or self.closed)
+                if not self.entries:
+                    break
+                device_name, name, log = self.entries.popleft()
+                self.queued.notify_all()
+                try:
+                    with self.zip_file.open(name, "w") as entry:
+                        shutil.copyfileobj(log, entry)
+                except Exception as e:
+                    # keep draining so the workers don't block, close() raises it
+                    if self.error is None:
+                        self.error = e
+                finally:
+                    log.close()
+                    self.pending[device_name] -= 1
+                    self.written.notify_all()
+
+    def sync(self, device_name):
+        """
+        Waits until the logs of the device are written and flushes them to disk,
+        so they survive an interruption once the device is journaled
+        """
+        with self.lock:
+            self.written.wait_for(lambda: not self.pending[device_name])
+            self.pending.pop(device_name, None)
+            self.zip_file.fp.flush()
+            os.fsync(self.zip_file.fp.fileno())
+
+    def recover(self, hosts):
+        """
+        Rewrites the archive with only the logs of the given hosts, the archive of
+        an interrupted run is readable again afterwards
+        """
+        with ZipFile(
+            f"{self.path}.tmp",
+            "w",
+            compression=self.COMPRESSION[self.compression],
+            compresslevel=self.compresslevel,
+        ) as recovered:
+            recovered_logs = set()
+            for name, data in self._read_entries(self.path):
+                if self._host(name) in hosts:
+                    recovered.writestr(name, data)
+                    recovered_logs.add(name)
+        os.replace(f"{self.path}.tmp", self.path)
+
+        for device_name in hosts:
+            if any(
+                f"{device_name}_{log_file}" not in recovered_logs
+                for log_file in ArchiveDevice.LOGS
+            ):
+                print(
+                    f"Could not recover the RPC logs of {device_name} from "
+                    f"{self.path}, it can't be replayed"
+                )
+
+    @staticmethod
+    def _host(name):
+        for log_file in ArchiveDevice.LOGS + ArchiveDevice.OPTIONAL_LOGS:
+            if name.endswith(f"_{log_file}"):
+                return name[: -len(f"_{log_file}")]
+        return None
+
+    @staticmethod
+    def _read_entries(path):
+        if zipfile.is_zipfile(path):
+            with ZipFile(path) as source:
+                for info in source.infolist():
+                    yield info.filename, source.read(info)
+            return
+
+        # the central directory is only written when the archive is closed, so the
+        # entries of an interrupted run are read from their local headers instead
+        decompress = {
+            zipfile.ZIP_STORED: bytes,
+            zipfile.ZIP_DEFLATED: partial(zlib.decompress, wbits=-15),
+            zipfile.ZIP_BZIP2: bz2.decompress,
+            zipfile.ZIP_LZMA: RpcArchive._decompress_lzma,
+        }
+        if hasattr(zipfile, "ZIP_ZSTANDARD"):
+            from compression import zstd
+
+            decompress[zipfile.ZIP_ZSTANDARD] = zstd.decompress
+        with open(path, "rb") as source:
+            while True:
+                header = source.read(zipfile.sizeFileHeader)
+                if (
+                    len(header) < zipfile.sizeFileHeader
+                    or header[:4] != zipfile.stringFileHeader
+                ):
+                    return
+                *_, method, _, _, crc, size, _, name_length, extra_length = (
+                    struct.unpack(zipfile.structFileHeader, header)
+                )
+                name = source.read(name_length).decode()
+                source.read(extra_length)
+                data = source.read(size)
+                # stop at the entry that was being written when the run was killed
+                if len(data) < size:
+                    return
+                if method not in decompress:
+                    print(f"Can't recover {name} compressed with method {method}")
+                    return
+                data = decompress[method](data)
+                if zlib.crc32(data) != crc:
+                    return
+                yield name, data
+
+    @staticmethod
+    def _decompress_lzma(data):
+        # zip stores raw LZMA behind a version and the size of the properties,
+        # the 5 properties bytes hold lc, lp and pb followed by the dictionary size
+        (properties_size,) = struct.unpack("<H", data[2:4])
+        properties = data[4 : 4 + properties_size]
+        lp, lc = divmod(properties[0], 9)
+        pb, lp = divmod(lp, 5)
+        (dict_size,) = struct.unpack("<I", properties[1:5])
+        decompressor = lzma.LZMADecompressor(
+            lzma.FORMAT_RAW,
+            filters=[
+                {
+                    "id": lzma.FILTER_LZMA1,
+                    "dict_size": dict_size,
+                    "lc": lc,
+                    "lp": lp,
+                    "pb": pb,
+                }
+            ],
+        )
+        return decompressor.decompress(data[4 + properties_size :])
+
+    @contextmanager
+    def open_log(self, device_name, log_file):
+        name = f"{device_name}_{log_file}"
+        if self.entries is not None:
+            log = SpooledTemporaryFile(self.SPOOL_SIZE)
+            yield log
+            log.seek(0)
+            with self.lock:
+                self.queued.wait_for(
+                    lambda: self.closed or len(self.entries) < self.QUEUE_SIZE
+                )
+                if self.closed:
+                    log.close()
+                    return
+                self.entries.append((device_name, name, log))
+                self.pending[device_name] += 1
+                self.queued.notify_all()
+            return
+        # a zip archive can only be written to one entry at a time
+        with self.lock:
+            if self.closed:
+                yield BytesIO()
+                return
+            with self.zip_file.open(name, "w") as log:
+                yield log
+
+    def write(self, device_name, log_file, data):
+        with self.open_log(device_name, log_file) as log:
+            log.write(data)
+
+    def copy(self, path):
+        # add the RPC logs of another archive, e.g. the one of a shard
+        with ZipFile(path) as source, self.lock:
+            for info in source.infolist():
+                if info.filename != "missing_devices.txt":
+                    self.zip_file.writestr(info.filename, source.read(info))
+
+    def close(self, missing_devices=()):
+        with self.lock:
+            self.closed = True
+            self.queued.notify_all()
+        if self.writer is not None:
+            self.writer.join()
+        with self.lock:
+            self.zip_file.writestr("missing_devices.txt", "\n".join(missing_devices))
+            self.zip_file.close()
+        if self.error is not None:
+            raise self.error
+
+
+class ArchiveDevice:
+    """
+    Stand-in for a PyEZ Device that answers the RPCs with the replies archived
+    by a previous run, either from rpc_logs.zip or from a directory of logs
+    """
+
+    LOGS = [
+        "interface_config.xml",
+        "interface_media.xml",
+        "chassis_hardware.xml",
+    ]
+    OPTIONAL_LOGS = [
+        "license_summary.xml",
+        "facts.yaml",
+    ]
+
+    def __init__(self, device_name, archive="rpc_logs.zip"):
+        self.device_name = device_name
+        self.archive = archive
+        self.facts = {}
+        # RPCs are answered by the archive itself, mirroring Device.rpc
+        self.rpc = self
+
+    def _is_directory(self):
+        return isinstance(self.archive, str) and os.path.isdir(self.archive)
+
+    @contextmanager
+    def _zip_file(self):
+        # a replay shares one opened archive between all of its devices
+        if isinstance(self.archive, ZipFile):
+            yield self.archive
+        else:
+            with ZipFile(self.archive) as zip_file:
+                yield zip_file
+
+    def _list_logs(self):
+        if self._is_directory():
+            return os.listdir(self.archive)
+        with self._zip_file() as zip_file:
+            return zip_file.namelist()
+
+    def _read(self, log_file, default=None):
+        path = f"{self.device_name}_{log_file}"
+        try:
+            if self._is_directory():
+                with open(os.path.join(self.archive, path), "rb") as rpc_log:
+                    return rpc_log.read()
+            with self._zip_file() as zip_file:
+                return zip_file.read(path)
+        except (FileNotFoundError, KeyError):
+            if default is None:
+                raise
+            return default
+
+    def list_hosts(self):
+        logs = set(self._list_logs())
+        suffix = f"_{self.LOGS[0]}"
+        hosts = [log[: -len(suffix)] for log in logs if log.endswith(suffix)]
+        return sorted(
+            host
+            for host in hosts
+            if all(f"{host}_{log_file}" in logs for log_file in self.LOGS)
+        )
+
+    def open(self):
+        # runs archived before the facts were logged fall back to an unknown version
+        facts = yaml.safe_load(self._read("facts.yaml", b"{}")) or {}
+        self.facts = {"version": "N/A", **facts}
+
+    def close(self):
+        pass
+
+    def get_config(self, filter_xml=None, options=None):
+        return etree.fromstring(self._read("interface_config.xml"))
+
+    def get_interface_information(self, **kwargs):
+        return etree.fromstring(self._read("interface_media.xml"))
+
+    @contextmanager
+    def stream_interface_information(self):
+        path = f"{self.device_name}_interface_media.xml"
+        if self._is_directory():
+            with open(os.path.join(self.archive, path), "rb") as stream:
+                yield stream
+        else:
+            with self._zip_file() as zip_file, zip_file.open(path) as stream:
+                yield stream
+
+    def get_chassis_inventory(self, **kwargs):
+        return etree.fromstring(self._read("chassis_hardware.xml"))
+
+    def get_commit_information(self, **kwargs):
+        # not archived, the configuration revision is unknown
+        return etree.fromstring(
+            self._read("commit_information.xml", b"<commit-information/>")
+        )
+
+    def get_license_summary_information(self, **kwargs):
+        return etree.fromstring(
+            self._read("license_summary.xml", b"<license-summary-information/>")
+        )
+
+
+class CollectedDevice(ArchiveDevice):
+    """
+    Stand-in for a PyEZ Device that answers the RPCs with raw replies collected
+    in memory, so they can be parsed away from the device session
+    """
+
+    def __init__(self, device_name, replies=None):
+        super().__init__(device_name, None)
+        self.replies = replies if replies is not None else {}
+        # timings of the collection stage, see JunosDevice.timings
+        self.timings = {}
+        # the cache decision of the collection stage, see JunosDevice.cache_lookup
+        self.cache_lookup = None
+
+    def _list_logs(self):
+        return [f"{self.device_name}_{log_file}" for log_file in self.replies]
+
+    def _read(self, log_file, default=None):
+        if log_file in self.replies:
+            return self.replies[log_file]
+        if default is None:
+            raise KeyError(log_file)
+        return default
+
+    @contextmanager
+    def stream_interface_information(self):
+        yield BytesIO(self._read("interface_media.xml"))
+
+    def log_replies(self, archive=None):
+        # Log the RPC output for later review
+        for log_file in self.LOGS + self.OPTIONAL_LOGS:
+            if log_file not in self.replies:
+                continue
+            if archive is not None:
+                archive.write(self.device_name, log_file, self.replies[log_file])
+            else:
+                with open(f"{self.device_name}_{log_file}", "wb") as rpc_log:
+                    rpc_log.write(self.replies[log_file])
+
+
+class AsyncCollector:
+    """
+    Collects the RPC replies of all devices from a single event loop. PyEZ only
+    offers a blocking session so every RPC is dispatched to an I/O thread and
+    bounded by the RPC timeout, parsing the replies is handed to a separate executor
+    """
+
+    def __init__(self, capacity, max_concurrency=100, rpc_timeout=300):
+        self.capacity = capacity
+        self.max_concurrency = max_concurrency
+        self.rpc_timeout = rpc_timeout
+        self.io_executor = None
+        self.parse_executor = None
+        self.semaphore = None
+        self.tag_semaphores = {}
+        self.tasks = set()
+        # the last call dispatched to the I/O threads per device
+        self.calls = {}
+
+    def run(self, device_list, deadline=None):
+        asyncio.run(self._run(device_list, deadline))
+
+    def retry(self, device_name):
+        # queues up behind the semaphores again, after every waiting device
+        self.tasks.add(asyncio.ensure_future(self.check_device(device_name)))
+
+    async def _run(self, device_list, deadline=None):
+        self.io_executor = ThreadPoolExecutor(self.max_concurrency)
+        if self.capacity.parse_processes is not None:
+            self.parse_executor = ProcessPoolExecutor(self.capacity.parse_processes)
+        else:
+            self.parse_executor = ThreadPoolExecutor(os.cpu_count())
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        # optional per site/jumphost limits, same as the HostScheduler
+        self.tag_semaphores = {
+            (tag, value): asyncio.Semaphore(limit)
+            for tag, tag_limits in self.capacity.limits.items()
+            for value, limit in tag_limits.items()
+        }
+        self.tasks = {
+            asyncio.ensure_future(self.check_device(device_name))
+            for device_name in device_list
+        }
+        try:
+            while self.tasks:
+                remaining = None
+                if deadline is not None:
+                    remaining = max(0, deadline - perf_counter())
+                done, _ = await asyncio.wait(
+                    self.tasks, timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    break
+                self.tasks -= done
+        finally:
+            # the devices that are still busy at the deadline are reported as missing
+            for task in self.tasks:
+                task.cancel()
+            self.io_executor.shutdown(wait=False)
+            self.parse_executor.shutdown()
+
+    async def _call(self, device_name, function, *args, **kwargs):
+        # PyEZ can't interrupt an RPC, a call that times out keeps running on its
+        # thread and only the wait for it is abandoned
+        call = self.io_executor.submit(function, *args, **kwargs)
+        self.calls[device_name] = call
+        return await asyncio.wait_for(asyncio.wrap_future(call), self.rpc_timeout)
+
+    async def _disconnect(self, device):
+        """
+        Closes the session once its thread is done with it. Until then the device
+        keeps its slot, so the I/O threads never run more calls than there are
+        slots and no call waits for a thread behind one that timed out
+        """
+        call = self.calls.pop(device.device_name, None)
+        if call is not None and not call.done():
+            try:
+                await asyncio.wrap_future(call)
+            except asyncio.CancelledError:
+                # past the deadline, the thread closes the session when it returns
+                call.add_done_callback(lambda _: device.close_quietly())
+                raise
+            except Exception:
+                pass
+        try:
+            await self._call(device.device_name, device.disconnect)
+        except (asyncio.TimeoutError, Exception):
+            pass
+        self.calls.pop(device.device_name, None)
+
+    async def collect(self, device_name):
+        device = JunosDevice(
+            device_name,
+            None,
+            self.capacity.log_rpc,
+            cache=self.capacity.cache,
+            connections=self.capacity.connections,
+            rpc_filtering=self.capacity.rpc_filtering,
+        )
+        collected = CollectedDevice(device_name)
+        # parses the replies that decide which other RPCs are needed
+        parser = JunosDevice(device_name, None, False, collected, device.cache)
+
+        try:
+            with device._timed("connect"):
+                await self._call(
+                    device_name, self.capacity.connections.open, device.device
+                )
+            version = await self._call(
+                device_name, lambda: device.device.facts["version"]
+            )
+            collected.replies["facts.yaml"] = device.facts_reply(version)
+            for log_file in parser.iter_required_rpcs(version):
+                collected.replies[log_file] = await self._call(
+                    device_name, device.fetch_reply, log_file, self.rpc_timeout
+                )
+            collected.cache_lookup = parser.cache_lookup
+        except (asyncio.TimeoutError, Exception):
+            # the remaining RPCs of this device are cancelled
+            self.capacity.metrics.record_device(device_name, device.timings)
+            raise
+        finally:
+            await self._disconnect(device)
+
+        if self.capacity.log_rpc:
+            with device._timed("log_rpc"):
+                await self._call(
+                    device_name, collected.log_replies, self.capacity.archive
+                )
+            self.calls.pop(device_name, None)
+
+        collected.timings = device.timings
+        return collected
+
+    async def check_device(self, device_name):
+        tags = self.capacity.host_tags.get(device_name, {})
+        async with AsyncExitStack() as stack:
+            # take the site/jumphost slots before the global one so waiting
+            # devices don't hold up devices behind other jumphosts
+            for key in sorted(self.tag_semaphores):
+                tag, value = key
+                if tags.get(tag) == value:
+                    await stack.enter_async_context(self.tag_semaphores[key])
+            await stack.enter_async_context(self.semaphore)
+            try:
+                collected = await self.collect(device_name)
+            except (asyncio.TimeoutError, Exception) as e:
+                self.capacity.record_failure(device_name, failure_reason(e), self)
+                return
+
+        loop = asyncio.get_running_loop()
+        try:
+            entry = await loop.run_in_executor(
+                self.parse_executor,
+                parse_collected_replies,
+                device_name,
+                collected.replies,
+                self.capacity.cache,
+                collected.timings,
+                self.capacity.profile,
+                self.capacity.profile_dir,
+                collected.cache_lookup,
+            )
+        except Exception as e:
+            self.capacity.metrics.record_device(device_name, collected.timings)
+            self.capacity.record_failure(device_name, failure_reason(e))
+            return
+        if entry is not None:
+            self.capacity.queue.put(entry)
+
+
 class JunosDevice:
-    def __init__(self, device_name, queue, log_rpc):
+    # RPCs used by the capacity check, keyed on the file their reply is logged to
+    RPCS = {
+        "commit_information.xml": ("get_commit_information", {"normalize": True}),
+        "license_summary.xml": ("get_license_summary_information", {"normalize": True}),
+        "interface_config.xml": (
+            "get_config",
+            {"filter_xml": "interfaces", "options": {"format": "set"}},
+        ),
+        "chassis_hardware.xml": ("get_chassis_inventory", {"normalize": True}),
+        "interface_media.xml": (
+            "get_interface_information",
+            {"media": True, "detail": True, "normalize": True},
+        ),
+    }
+    # configuration filter that only selects what _get_layer looks at
+    FILTERED_CONFIG = (
+        "<configuration><interfaces><interface><name/>"
+        "<unit><name/><family/></unit><ether-options/><gigether-options/>"
+        "</interface></interfaces></configuration>"
+    )
+
+    def __init__(
+        self,
+        device_name,
+        queue,
+        log_rpc,
+        device=None,
+        cache=None,
+        connections=None,
+        archive=None,
+        rpc_filtering=False,
+    ):
         self.device_name = device_name
         self.queue = queue
-        self.device = Device(host=device_name, user=username, password=password)
+        # only ask the device for the interfaces and statements that are checked
+        self.rpc_filtering = rpc_filtering
+        self.connections = connections
+        # RpcArchive the replies are logged to, without one they're written to files
+        self.archive = archive
+        # any object that quacks like a PyEZ Device can be used as the RPC source
+        if device is None:
+            if connections is None:
+                connections = ConnectionManager()
+                self.connections = connections
+            device = connections.device(device_name)
+        self.device = device
         self.log_rpc = log_rpc
+        self.cache = cache
+        # decided once per device, a parse stage gets the one of the collection
+        # stage so the TTL can't expire in between and leave replies missing
+        self.cache_lookup = None
+        # why the device couldn't be checked, e.g. ConnectAuthError
+        self.failure = None
+        # exclusive time per stage, e.g. connect, rpc:interface_media, get_chassis_info
+        # and the size of the replies pulled from the device, e.g. bytes:interface_media
+        self.timings = {}
+        self._timer_stack = []
+        self.reported = False
 
         self.NAG_VERSION = "22.2R1"
         self.EVO_NAG_VERSION = "21.1"
         self.INTERFACE_PREFIXES = ["et", "ge", "xe", "xle", "fte"]  # ,"ae"]
 
+    @contextmanager
+    def _timed(self, stage):
+        # nested stages are subtracted so every stage only counts its own time
+        start = perf_counter()
+        self._timer_stack.append(0)
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            nested = self._timer_stack.pop()
+            self.timings[stage] = self.timings.get(stage, 0) + elapsed - nested
+            if self._timer_stack:
+                self._timer_stack[-1] += elapsed
+
+    def _report(self, entry):
+        entry["timings"] = dict(self.timings)
+        self.reported = True
+        self.queue.put(entry)
+
     def connect(self):
         try:
-            self.device.open()
+            with self._timed("connect"):
+                if self.connections is not None:
+                    self.connections.open(self.device)
+                else:
+                    self.device.open()
             return True
-        except ConnectTimeoutError as e:
-            print(f"Could not connect to {self.device_name}")
+        except junos_exceptions("ConnectError") as e:
+            self.failure = failure_reason(e)
+            print(f"Could not connect to {self.device_name}: {self.failure}")
             return False
 
     def disconnect(self):
         self.device.close()
 
+    def close_quietly(self):
+        try:
+            self.disconnect()
+        except Exception:
+            # the session may already have been dropped, which doesn't undo the
+            # replies that were already pulled
+            pass
+
+    def facts_reply(self, version):
+        return yaml.safe_dump({"version": version}).encode()
+
+    def rpc_calls(self, log_file):
+        """
+        Returns the (rpc name, kwargs) calls answering log_file. With RPC filtering
+        the interfaces are requested per prefix and only the configuration
+        statements the layer detection relies on are pulled
+        """
+        rpc_name, kwargs = self.RPCS[log_file]
+        if not self.rpc_filtering:
+            return [(rpc_name, kwargs)]
+
+        if log_file == "interface_config.xml":
+            return [(rpc_name, {**kwargs, "filter_xml": self.FILTERED_CONFIG})]
+        if log_file == "interface_media.xml":
+            calls = [
+                (rpc_name, {**kwargs, "interface_name": f"{prefix}-*"})
+                for prefix in self.INTERFACE_PREFIXES
+            ]
+            # AE members take the address of their bundle, which terse includes
+            calls.append(
+                (rpc_name, {"terse": True, "interface_name": "ae*", "normalize": True})
+            )
+            return calls
+        return [(rpc_name, kwargs)]
+
+    def _request(self, log_file, rpc_timeout=None):
+        # run the calls answering log_file, merging their replies into the first one
+        calls = self.rpc_calls(log_file)
+        reply = None
+        for rpc_name, kwargs in calls:
+            if rpc_timeout is not None:
+                kwargs = {**kwargs, "dev_timeout": rpc_timeout}
+            try:
+                part = getattr(self.device.rpc, rpc_name)(**kwargs)
+            except junos_exceptions("RpcError"):
+                # a wildcard that matches no interfaces on this device
+                if len(calls) == 1:
+                    raise
+                continue
+            if len(calls) == 1:
+                return part
+            # PyEZ returns True instead of an empty reply
+            if isinstance(part, bool):
+                continue
+            if reply is None:
+                reply = part
+            else:
+                reply.extend(part)
+        if reply is None:
+            reply = etree.Element("interface-information")
+        return reply
+
+    def _record_bytes(self, log_file, size):
+        # replies replayed from an archive were not pulled from the device
+        if not isinstance(self.device, ArchiveDevice):
+            stage = f"bytes:{os.path.splitext(log_file)[0]}"
+            self.timings[stage] = self.timings.get(stage, 0) + size
+
+    def fetch_reply(self, log_file, rpc_timeout=None):
+        with self._timed(f"rpc:{os.path.splitext(log_file)[0]}"):
+            reply = self._request(log_file, rpc_timeout)
+            data = etree.tostring(reply, method="xml", encoding="utf-8")
+        self._record_bytes(log_file, len(data))
+        return data
+
+    def iter_required_rpcs(self, version):
+        """
+        Yields the RPCs the capacity check needs one at a time, the reply of each
+        one has to be available from self.device before the next one is requested
+        """
+        if self.cache is not None:
+            yield "commit_information.xml"
+            self.cache_lookup = self.cache.lookup(
+                self.device_name, version, self.get_commit_revision()
+            )
+            if self.cache_lookup.valid:
+                return
+
+        if self.has_license_nag(version):
+            yield "license_summary.xml"
+        yield "interface_config.xml"
+        # the inventory rarely changes, reuse it until the cache TTL expires
+        if self.cache_lookup is None or not self.cache_lookup.fresh:
+            yield "chassis_hardware.xml"
+        yield "interface_media.xml"
+
+    def collect_replies(self):
+        """
+        Pull the raw replies of the RPCs without parsing them, the capacity check
+        can then run on the returned CollectedDevice
+        """
+        if not self.connect():
+            return None
+
+        collected = CollectedDevice(self.device_name)
+        parser = JunosDevice(self.device_name, None, False, collected, self.cache)
+        try:
+            version = self.device.facts["version"]
+            collected.replies["facts.yaml"] = self.facts_reply(version)
+            for log_file in parser.iter_required_rpcs(version):
+                collected.replies[log_file] = self.fetch_reply(log_file)
+            collected.cache_lookup = parser.cache_lookup
+        finally:
+            self.close_quietly()
+
+        if self.log_rpc:
+            with self._timed("log_rpc"):
+                collected.log_replies(self.archive)
+
+        collected.timings = self.timings
+        return collected
+
     def __enter__(self):
         self.device.open()
 
@@ -192,6 +2707,33 @@ class JunosDevice:
             value = value.strip()
         return value
 
+    def _call_rpc(self, log_file):
+        with self._timed(f"rpc:{os.path.splitext(log_file)[0]}"):
+            reply = self._request(log_file)
+        archived = log_file in ArchiveDevice.LOGS + ArchiveDevice.OPTIONAL_LOGS
+        if self.log_rpc and archived:
+            # the size of the reply is counted while it's written to the log
+            with self._timed("log_rpc"):
+                size = self._log_rpc_reply(log_file, reply)
+            self._record_bytes(log_file, size)
+        elif archived and not isinstance(self.device, ArchiveDevice):
+            counter = CountingWriter()
+            etree.ElementTree(reply).write(counter, method="xml", encoding="utf-8")
+            self._record_bytes(log_file, counter.size)
+        return reply
+
+    def _open_log(self, log_file):
+        if self.archive is not None:
+            return self.archive.open_log(self.device_name, log_file)
+        return open(f"{self.device_name}_{log_file}", "wb")
+
+    def _log_rpc_reply(self, log_file, reply):
+        # Log the RPC output for later review, serialized straight to the archive
+        with self._open_log(log_file) as rpc_log:
+            counted_log = CountingWriter(rpc_log)
+            etree.ElementTree(reply).write(counted_log, method="xml", encoding="utf-8")
+        return counted_log.size
+
     def _get_layer(self, layer_config):
         if (
             "ethernet-switching interface-mode trunk" in layer_config
@@ -208,6 +2750,7 @@ class JunosDevice:
 
         return None
 
+    @timed
     def get_linecard_capacity(self, linecard_interfaces, linecard_details):
         """
         print("Checking the following linecard interfaces:")
@@ -225,10 +2768,15 @@ class JunosDevice:
             """
             speed = "N/A"
             channel = "default"
-            _, pic, slot = interface.split("-")[1].split("/")
+            interface_name = parse_interface_name(interface)
+            # e.g. ae0 or irb, only physical ports count towards the linecard
+            if interface_name is None:
+                continue
+            pic = interface_name.pic
+            slot = interface_name.port
             # check if we're dealing with channelized interfaces
-            if ":" in slot:
-                slot, channel = slot.split(":")
+            if interface_name.channel is not None:
+                channel = interface_name.channel
                 channelized_ports += 1
             if info["admin_status"] == "up" and (
                 info["layer"] == 2
@@ -264,96 +2812,185 @@ class JunosDevice:
 
         return (channelized_ports, len(ports_in_use), linecard_capacity)
 
-    def get_address(self, interface_info, physical_interface):
-        for logical_interface in interface_info.xpath(
-            f".//physical-interface/logical-interface[starts-with(name,'{physical_interface}')]"
-        ):
-            name = self._get_field(logical_interface, "name")
-
-            # check to see if the interface belongs to an AE bundle
-            ae_bundle = self._get_field(
-                logical_interface, ".//address-family/ae-bundle-name"
+    def _interface_record(self, physical_interface):
+        # only keep the fields the capacity calculations rely on
+        units = []
+        for logical_interface in physical_interface.iterchildren("logical-interface"):
+            units.append(
+                (
+                    self._get_field(logical_interface, "name"),
+                    # check to see if the interface belongs to an AE bundle
+                    self._get_field(
+                        logical_interface, ".//address-family/ae-bundle-name"
+                    ),
+                    self._get_field(
+                        logical_interface,
+                        ".//address-family/interface-address/ifa-local",
+                    ),
+                )
             )
+        return {
+            "name": self._get_field(physical_interface, "name"),
+            "admin_status": self._get_field(physical_interface, "admin-status"),
+            "oper_status": self._get_field(physical_interface, "oper-status"),
+            "speed": self._get_field(physical_interface, "speed", "0"),
+            "units": units,
+        }
+
+    def iter_interface_records(self, interface_info):
+        # the reply has already been parsed, free every interface once it's read
+        for physical_interface in interface_info.iter("physical-interface"):
+            yield self._interface_record(physical_interface)
+            physical_interface.clear()
 
+    def iterparse_interface_records(self, stream):
+        # parse the raw reply incrementally so only one interface is held in memory
+        for _, physical_interface in etree.iterparse(
+            stream, events=("end",), tag="physical-interface"
+        ):
+            yield self._interface_record(physical_interface)
+            physical_interface.clear()
+            while physical_interface.getprevious() is not None:
+                del physical_interface.getparent()[0]
+
+    def index_logical_interfaces(self, interface_records):
+        """
+        Collect the units of every interface in a single pass, keyed on both the
+        physical interface name and the unit name (AE bundles refer to the unit)
+        """
+        logical_interfaces = defaultdict(list)
+        for record in interface_records:
+            physical_name = record["name"]
+            for unit in record["units"]:
+                logical_interfaces[physical_name].append(unit)
+                if unit[0] != physical_name:
+                    logical_interfaces[unit[0]].append(unit)
+        return logical_interfaces
+
+    def get_address(self, logical_interfaces, physical_interface, resolved=None):
+        # AE addresses are shared by all member links so only resolve them once
+        if resolved is None:
+            resolved = {}
+        if physical_interface in resolved:
+            return resolved[physical_interface]
+
+        result = (None, None)
+        for name, ae_bundle, address in logical_interfaces.get(physical_interface, []):
             if ae_bundle is not None:
-                address = self.get_address(interface_info, ae_bundle)
-            else:
-                address = self._get_field(
-                    logical_interface, ".//address-family/interface-address/ifa-local"
-                )
+                address = self.get_address(logical_interfaces, ae_bundle, resolved)
             if address is not None:
-                return name, address
-        return None, None
+                result = (name, address)
+                break
+
+        resolved[physical_interface] = result
+        return result
 
-    def _is_active_configuration(self, config, deactivate_config):
+    def _build_deactivate_tree(self, deactivate_config):
+        # prefix tree of the deactivated statement paths, None marks the end of a path
+        deactivate_tree = {}
         for dc in deactivate_config:
-            if dc[len("deactivate ") :] in config:
+            node = deactivate_tree
+            for token in dc.split()[1:]:
+                node = node.setdefault(token, {})
+            node[None] = True
+        return deactivate_tree
+
+    def _is_active_configuration(self, config, deactivate_tree):
+        # walk the statement path, it's inactive if any of its parents is deactivated
+        node = deactivate_tree
+        for token in config.split()[1:]:
+            node = node.get(token)
+            if node is None:
+                return True
+            if None in node:
                 return False
         return True
 
+    def filter_deactivated_configuration(self, interface_config):
+        deactivate_config = []
+        active_config = []
+        for config in interface_config:
+            if config.startswith("deactivate"):
+                deactivate_config.append(config)
+            else:
+                active_config.append(config)
+
+        deactivate_tree = self._build_deactivate_tree(deactivate_config)
+
+        return [
+            config
+            for config in active_config
+            if self._is_active_configuration(config, deactivate_tree)
+        ]
+
+    @timed
     def get_interface_configuration(self):
-        interface_config = self.device.rpc.get_config(
-            filter_xml="interfaces", options={"format": "set"}
-        )
-        # Log the RPC output for later review
-        if self.log_rpc:
-            with open(f"{self.device_name}_interface_config.xml", "w+") as rpc_log:
-                rpc_log.write(
-                    etree.tostring(interface_config, method="xml", encoding="unicode")
-                )
+        interface_config = self._call_rpc("interface_config.xml")
 
         interface_config = interface_config.findall(".")[0].text.splitlines()
 
         # Parse out any deactivated statements
-        deactivate_config = [
-            config for config in interface_config if config.startswith("deactivate")
-        ]
-        interface_config = [
-            config for config in interface_config if config not in deactivate_config
-        ]
-
-        new_config = [
-            config
-            for config in interface_config
-            if self._is_active_configuration(config, deactivate_config)
-        ]
+        new_config = self.filter_deactivated_configuration(interface_config)
 
         return "\n".join(new_config)
 
+    def index_interface_configuration(self, interface_config):
+        """
+        Group the configuration lines by the exact interface names they mention
+        so an interface doesn't pick up the lines of another one sharing its prefix
+        (e.g. et-0/0/1 and et-0/0/10)
+        """
+        config_index = defaultdict(list)
+        for config in interface_config.splitlines():
+            names = set()
+            for token in config.split():
+                if "/" not in token or "-" not in token:
+                    continue
+                # the unit is not part of the physical interface name
+                name = token.split(".")[0]
+                if name not in names:
+                    names.add(name)
+                    config_index[name].append(config)
+        return config_index
+
+    @timed
     def get_interface_details(self, interface_config):
         interface_details = {}
         ae_members = defaultdict(list)
-        interface_info = self.device.rpc.get_interface_information(
-            media=True, detail=True, normalize=True
-        )
-        if self.log_rpc:
-            # Log the RPC output for later review
-            with open(f"{self.device_name}_interface_media.xml", "w+") as rpc_log:
-                rpc_log.write(
-                    etree.tostring(interface_info, method="xml", encoding="unicode")
-                )
+        config_index = self.index_interface_configuration(interface_config)
+        if hasattr(self.device, "stream_interface_information"):
+            # raw replies (e.g. archived logs) can be parsed as a stream
+            with self.device.stream_interface_information() as stream:
+                interface_records = list(self.iterparse_interface_records(stream))
+        else:
+            interface_info = self._call_rpc("interface_media.xml")
+            interface_records = list(self.iter_interface_records(interface_info))
+            del interface_info
+
+        logical_interfaces = self.index_logical_interfaces(interface_records)
+        resolved_addresses = {}
 
-        for physical_interface in interface_info.xpath(".//physical-interface"):
-            name = self._get_field(physical_interface, "name")
+        for record in interface_records:
+            name = record["name"]
 
             if not self._validate_prefix(name):
                 continue
 
-            admin_status = self._get_field(physical_interface, "admin-status")
-            oper_status = self._get_field(physical_interface, "oper-status")
-            speed = self._get_field(physical_interface, "speed", "0")
+            admin_status = record["admin_status"]
+            oper_status = record["oper_status"]
+            speed = record["speed"]
             logical_interface = None
             address = None
             ae = None
 
             # determine if it's configured as layer 2 or 3
-            layer_config = "\n".join(
-                [config for config in interface_config.splitlines() if name in config]
-            )
+            layer_config = "\n".join(config_index.get(name, []))
             layer = self._get_layer(layer_config)
 
             if layer == 3:
-                logical_interface, address = self.get_address(interface_info, name)
+                logical_interface, address = self.get_address(
+                    logical_interfaces, name, resolved_addresses
+                )
 
             if type(address) is tuple:
                 ae, address = address
@@ -384,10 +3021,9 @@ class JunosDevice:
 
         return interface_details
 
+    @timed
     def get_license_usage(self):
-        license_summary = self.device.rpc.get_license_summary_information(
-            normalize=True
-        )
+        license_summary = self._call_rpc("license_summary.xml")
         feature_summary_path = (
             './/feature-summary[description="Port Bandwidth Usage (PAYG license)"]'
         )
@@ -402,16 +3038,11 @@ class JunosDevice:
 
         return (used_license, available_license)
 
+    @timed
     def get_chassis_info(self):
         chassis_details = {}
 
-        chassis_hardware = self.device.rpc.get_chassis_inventory(normalize=True)
-        # Log the RPC output for later review
-        if self.log_rpc:
-            with open(f"{self.device_name}_chassis_hardware.xml", "w+") as rpc_log:
-                rpc_log.write(
-                    etree.tostring(chassis_hardware, method="xml", encoding="unicode")
-                )
+        chassis_hardware = self._call_rpc("chassis_hardware.xml")
 
         chassis_info = chassis_hardware.xpath(".//chassis")[0]
         chassis_model = self._get_field(chassis_info, "description")
@@ -421,58 +3052,65 @@ class JunosDevice:
         chassis_details["serial"] = chassis_serial
         chassis_details["linecards"] = {}
 
-        fpc_xpaths = [
-            ".//chassis-module",
-            ".//chassis-sub-module",
-            ".//chassis-sub-sub-module",
-        ]
-        for fpc_xpath in fpc_xpaths:
-            for module in chassis_hardware.xpath(fpc_xpath):
-                name = self._get_field(module, "name")
-                if name.startswith("FPC"):
-                    serial = self._get_field(module, "serial-number")
-                    model = self._get_field(module, "description")
-                    version = self._get_field(module, "version", "")
-
-                    pics = defaultdict(dict)
-                    for sub_module in chassis_hardware.xpath(
-                        f"{fpc_xpath}[name='{name}']//name"
-                    ):
-                        sub_module_name = self._get_field(
-                            sub_module.getparent(), "name", "N/A"
-                        )
-                        if sub_module_name.startswith("Xcvr"):
-                            parent = sub_module.getparent()
-                            port_name = self._get_field(parent, "name", "N/A")
-                            port_model = self._get_field(parent, "description", "N/A")
-                            port_serial = self._get_field(
-                                parent, "serial-number", "N/A"
-                            )
-                            pic_name = self._get_field(
-                                parent.getparent(), "name", "N/A"
-                            )
-
-                            # assign 0 as a port channel by default
-                            pics[pic_name][port_name] = {
-                                "default": {
-                                    "model": port_model,
-                                    "serial": port_serial,
-                                    "speed": "N/A",
-                                }
-                            }
-
-                    chassis_details["linecards"][name] = {
-                        "model": model,
-                        "serial": serial,
-                        "version": version,
-                        "ports_installed": sum(
-                            [len(ports) for _, ports in pics.items()]
-                        ),
-                        "interfaces": pics,
+        # walk the inventory once, every Xcvr belongs to its nearest FPC ancestor
+        linecards = chassis_details["linecards"]
+        modules = [(child, None) for child in reversed(chassis_hardware)]
+        while modules:
+            module, linecard = modules.pop()
+            name = self._get_field(module, "name", "N/A")
+
+            if name.startswith("FPC") and module.tag.endswith("module"):
+                if name not in linecards:
+                    linecards[name] = {
+                        "model": self._get_field(module, "description"),
+                        "serial": self._get_field(module, "serial-number"),
+                        "version": self._get_field(module, "version", ""),
+                        "ports_installed": 0,
+                        "interfaces": defaultdict(dict),
                     }
+                linecard = linecards[name]
+            elif name.startswith("Xcvr") and linecard is not None:
+                pic_name = self._get_field(module.getparent(), "name", "N/A")
+                pics = linecard["interfaces"]
+                if name not in pics[pic_name]:
+                    linecard["ports_installed"] += 1
+
+                # assign 0 as a port channel by default
+                pics[pic_name][name] = {
+                    "default": {
+                        "model": self._get_field(module, "description", "N/A"),
+                        "serial": self._get_field(module, "serial-number", "N/A"),
+                        "speed": "N/A",
+                    }
+                }
+
+            # leaf fields (name, description, ...) have no children to visit
+            modules.extend(
+                (child, linecard) for child in reversed(module) if len(child)
+            )
 
         return chassis_details
 
+    @timed
+    def get_commit_revision(self):
+        # the last commit identifies the configuration revision without pulling it
+        commit_information = self._call_rpc("commit_information.xml")
+        commit = commit_information.find(".//commit-history")
+        if commit is None:
+            return None
+        return "|".join(
+            self._get_field(commit, field, "")
+            for field in ["sequence-number", "date-time", "user", "client"]
+        )
+
+    def has_license_nag(self, version):
+        # versions before the license nag need the port usage to be checked manually
+        is_evo = "EVO" in version.upper()
+        return not (
+            (is_evo and version < self.EVO_NAG_VERSION)
+            or (not is_evo and version < self.NAG_VERSION)
+        )
+
     def check_license_usage(self):
         used, available = self.get_license_usage()
         remaining = available - used
@@ -485,19 +3123,40 @@ class JunosDevice:
 
         # check version to see if license nag is present
         version = self.device.facts["version"]
-        is_evo = "EVO" in version.upper()
+        if self.log_rpc:
+            with self._open_log("facts.yaml") as facts_log:
+                facts_log.write(self.facts_reply(version))
+
+        # serve the device from the cache if nothing changed since the last run
+        if self.cache is not None and self.cache_lookup is None:
+            self.cache_lookup = self.cache.lookup(
+                self.device_name, version, self.get_commit_revision()
+            )
+        if self.cache_lookup is not None and self.cache_lookup.valid:
+            entry = self.cache_lookup.cached["entry"]
+            entry["cached"] = True
+            self._report(entry)
+            self.close_quietly()
+            return
 
         # if we are on a version before the license nag, let's manually check port usage
-        if (is_evo and version < self.EVO_NAG_VERSION) or (
-            not is_evo and version < self.NAG_VERSION
-        ):
+        if not self.has_license_nag(version):
             used, available, remaining = (0, 0, 0)
         else:
             used, available, remaining = self.check_license_usage()
             # Compare this to the manual calculations to determine any discrepenacies
 
         interface_config = self.get_interface_configuration()
-        chassis_details = self.get_chassis_info()
+        # the inventory rarely changes, reuse it until the cache TTL expires
+        if self.cache_lookup is not None and self.cache_lookup.fresh:
+            chassis_details = self.cache_lookup.cached["chassis_details"]
+            chassis_timestamp = self.cache_lookup.cached["chassis_timestamp"]
+        else:
+            chassis_details = self.get_chassis_info()
+            chassis_timestamp = time()
+        if self.cache is not None:
+            # the linecard details get updated below, keep the parsed inventory
+            cached_chassis_details = deepcopy(chassis_details)
         interface_details = self.get_interface_details(interface_config)
 
         total_ports = 0
@@ -517,18 +3176,24 @@ class JunosDevice:
             "linecards": {},
         }
 
+        # bucket the interfaces by FPC so every linecard only looks at its own
+        fpc_interfaces = defaultdict(list)
+        for interface, details in interface_details.items():
+            interface_name = parse_interface_name(interface)
+            if interface_name is not None:
+                fpc_interfaces[interface_name.fpc].append(
+                    (interface, interface_name, details)
+                )
+
         for linecard, linecard_details in chassis_details["linecards"].items():
             linecard_interfaces = {}
-            for interface, details in interface_details.items():
-                prefix, slot_info = interface.split("-")
-                fpc, pic, xcvr = slot_info.split("/")
-                if ":" in xcvr:
-                    xcvr, channel = xcvr.split(":")
-                pic_key = f"PIC {pic}"
-                xcvr_key = f"Xcvr {xcvr}"
+            for interface, interface_name, details in fpc_interfaces[
+                linecard.split(" ")[-1]
+            ]:
+                pic_key = f"PIC {interface_name.pic}"
+                xcvr_key = f"Xcvr {interface_name.port}"
                 if (
-                    f"-{linecard.split(' ')[1]}/" in interface
-                    and pic_key in linecard_details["interfaces"]
+                    pic_key in linecard_details["interfaces"]
                     and xcvr_key in linecard_details["interfaces"][pic_key]
                 ):
                     linecard_interfaces[interface] = details
@@ -565,15 +3230,155 @@ class JunosDevice:
         entry["chassis"].append(available)
         entry["chassis"].append(remaining)
 
-        self.queue.put(entry)
-        self.disconnect()
+        if self.cache is not None:
+            self.cache.save(
+                self.device_name,
+                {
+                    "version": version,
+                    "revision": self.cache_lookup.revision,
+                    "chassis_timestamp": chassis_timestamp,
+                    "chassis_details": cached_chassis_details,
+                    "entry": entry,
+                },
+            )
+
+        self._report(entry)
+        self.close_quietly()
+
+
+def parse_args(argv=None):
+    parser = ArgumentParser(
+        description="Collect the port capacity and license usage of Junos devices"
+    )
+    parser.add_argument("--hosts", default="hosts.yaml", help="hosts file")
+    parser.add_argument("--output", default="bandwidth_data.xlsx", help="report file")
+    parser.add_argument(
+        "--format",
+        dest="formats",
+        action="append",
+        choices=["xlsx", "csv", "jsonl", "parquet"],
+        help="report format, can be repeated (default: xlsx)",
+    )
+    parser.add_argument("--split-sheets", action="store_true")
+    parser.add_argument(
+        "--replay", metavar="ARCHIVE", help="regenerate the report from RPC logs"
+    )
+    parser.add_argument(
+        "--no-log-rpc",
+        dest="log_rpc",
+        action="store_false",
+        help="don't archive the RPC replies",
+    )
+    parser.add_argument("--archive", default="rpc_logs.zip", help="RPC log archive")
+    parser.add_argument("--max-workers", type=int, default=20)
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--parse-processes", type=int)
+    parser.add_argument("--cache-dir")
+    parser.add_argument("--deadline", type=float, help="seconds the run may take")
+    parser.add_argument("--rpc-filtering", action="store_true")
+    parser.add_argument("--summary", default="run_summary.json", help="run summary")
+    parser.add_argument(
+        "--journal",
+        default="capacity_journal.jsonl",
+        help="file the results of every device are saved to as it completes",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue an interrupted run, only polling the hosts not in --journal",
+    )
+    parser.add_argument(
+        "--shards", type=int, help="split the hosts over this number of collectors"
+    )
+    parser.add_argument(
+        "--shard", type=int, help="only collect this shard, numbered from 0"
+    )
+    parser.add_argument(
+        "--shard-by",
+        default="hash",
+        help="hash on the hostname or keep hosts sharing a tag (e.g. site) together",
+    )
+    parser.add_argument(
+        "--merge", action="store_true", help="merge the results of every shard"
+    )
+    parser.add_argument(
+        "--rollups",
+        action="store_true",
+        help="add rollups per site, model, linecard type and optic speed",
+    )
+    parser.add_argument("--history", metavar="DB", help="append the results to DB")
+    parser.add_argument(
+        "--query",
+        help=f"query the --history DB, one of {sorted(HISTORY_QUERIES)} or SQL",
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=0.8, help="license-usage threshold"
+    )
+    parser.add_argument(
+        "--since", default="", help="only query runs since, e.g. 2024-01-01"
+    )
+    parser.add_argument(
+        "--user", help=f"username (default: ${CredentialProvider.USERNAME_VARIABLE})"
+    )
+    parser.add_argument(
+        "--ssh-key", help="SSH private key, no password is prompted for with a key"
+    )
+    args = parser.parse_args(argv)
+    if args.query is not None and args.history is None:
+        parser.error("--query requires --history")
+    if (args.shard is not None or args.merge) and args.shards is None:
+        parser.error("--shard and --merge require --shards")
+    return args
 
 
-def main():
-    capacity = Capacity(
-        hosts_file="hosts.yaml", output_file="bandwidth_data.xlsx", log_rpc=True
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.query is not None:
+        columns, rows = query_history(
+            args.history, args.query, args.threshold, args.since
+        )
+        print("\t".join(columns))
+        for row in rows:
+            print("\t".join("" if value is None else str(value) for value in row))
+        return
+
+    # neither replaying nor merging connect to any device
+    credentials = None
+    if args.replay is None and not args.merge:
+        credentials = CredentialProvider(args.user, args.ssh_key).credentials()
+
+    options = dict(
+        hosts_file=args.hosts,
+        output_file=args.output,
+        log_rpc=args.log_rpc,
+        max_workers=args.max_workers,
+        replay=args.replay,
+        split_sheets=args.split_sheets,
+        output_formats=args.formats or ["xlsx"],
+        cache_dir=args.cache_dir,
+        engine=args.engine,
+        parse_processes=args.parse_processes,
+        metrics_file=args.summary,
+        deadline=args.deadline,
+        archive_path=args.archive,
+        rpc_filtering=args.rpc_filtering,
+        credentials=credentials,
+        history_db=args.history,
+        shards=args.shards,
+        shard_by=args.shard_by,
+        journal_file=args.journal,
+        resume=args.resume,
+        rollups=args.rollups,
     )
-    capacity.get_capacity_usage()
+    if args.merge:
+        Capacity(**options).merge_shards()
+    elif args.shard is not None:
+        run_shard(options, args.shard)
+    elif args.shards is not None:
+        run_shards(options)
+    else:
+        Capacity(**options).get_capacity_usage()
 
 
 if __name__ == "__main__":
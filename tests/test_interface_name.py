@@ -0,0 +1,109 @@
+"""
+Tests of the interface name parsing shared by the capacity calculations.
+
+    python3 -m pytest tests
+"""
+
+from queue import Queue
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from capacity_check import (  # noqa: E402
+    InterfaceName,
+    JunosDevice,
+    parse_interface_name,
+)
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        ("et-1/0/4", InterfaceName("et", "1", "0", "4", None)),
+        ("xe-0/1/10", InterfaceName("xe", "0", "1", "10", None)),
+        ("ge-11/3/47", InterfaceName("ge", "11", "3", "47", None)),
+        ("et-1/0/4:2", InterfaceName("et", "1", "0", "4", "2")),
+        ("xle-0/0/1:0", InterfaceName("xle", "0", "0", "1", "0")),
+    ],
+)
+def test_physical_names(name, expected):
+    assert parse_interface_name(name) == expected
+
+
+@pytest.mark.parametrize(
+    "name",
+    [
+        # logical units aren't physical interfaces
+        "et-1/0/4.0",
+        "et-1/0/4:2.100",
+        "ae0",
+        "ae0.0",
+        "irb",
+        "irb.10",
+        "fxp0",
+        "lo0.0",
+        "et-1/0",
+        "et-1/0/4:",
+        "",
+    ],
+)
+def test_other_names(name):
+    assert parse_interface_name(name) is None
+
+
+def linecard(ports):
+    return {
+        "interfaces": {
+            "PIC 0": {
+                f"Xcvr {port}": {
+                    "default": {"model": "QSFP-100GBASE-SR4", "serial": "X"}
+                }
+                for port in ports
+            }
+        }
+    }
+
+
+def interface(speed="100Gbps", admin_status="up"):
+    return {
+        "admin_status": admin_status,
+        "layer": 3,
+        "address": "192.0.2.1/31",
+        "speed": speed,
+    }
+
+
+def test_linecard_capacity():
+    device = JunosDevice("r1", Queue(), False, device=object())
+    linecard_details = linecard([0, 1, 2])
+    interfaces = {
+        "et-1/0/0": interface(),
+        "et-1/0/1:0": interface("25Gbps"),
+        "et-1/0/1:1": interface("25Gbps"),
+        "et-1/0/2": interface(admin_status="down"),
+    }
+
+    channelized, in_use, capacity = device.get_linecard_capacity(
+        interfaces, linecard_details
+    )
+
+    assert (channelized, in_use, capacity) == (2, 2, 150)
+    xcvrs = linecard_details["interfaces"]["PIC 0"]
+    assert xcvrs["Xcvr 0"]["default"]["speed"] == 100
+    assert xcvrs["Xcvr 1"]["1"] == {
+        "model": "QSFP-100GBASE-SR4",
+        "serial": "X",
+        "speed": 25,
+    }
+    assert xcvrs["Xcvr 2"]["default"]["speed"] == "N/A"
+
+
+def test_linecard_capacity_skips_other_names():
+    device = JunosDevice("r1", Queue(), False, device=object())
+    linecard_details = linecard([0])
+    interfaces = {"et-1/0/0": interface(), "ae0": interface(), "irb": interface()}
+
+    assert device.get_linecard_capacity(interfaces, linecard_details) == (0, 1, 100)
@@ -0,0 +1,25 @@
+"""
+Tests of the synthetic replies the benchmarks run the capacity check on.
+
+    python3 -m pytest tests
+"""
+
+import os
+import re
+import sys
+
+from lxml import etree
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+
+from synthetic import MODELS, interface_config, interface_information  # noqa: E402
+
+
+@pytest.mark.parametrize("model", sorted(MODELS))
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_replies_name_the_same_interfaces(model, seed):
+    config = etree.fromstring(interface_config(model, seed)).text
+    configured = set(re.findall(r"^set interfaces (\S+) ", config, re.MULTILINE))
+    information = etree.fromstring(interface_information(model, seed))
+    assert configured == set(information.xpath("physical-interface/name/text()"))